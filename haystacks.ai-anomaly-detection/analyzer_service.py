@@ -0,0 +1,161 @@
+import asyncio
+import json
+import time
+import argparse
+from collections import defaultdict, deque
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import pandas as pd
+from anomaly_analyzer import AnomalyAnalyzer
+
+#The service only ever listens on the loopback interface
+HOST = '127.0.0.1'
+
+def to_json(value):
+    """
+    Converts the numpy/pandas results of the analyzer into objects that json can serialize.
+    """
+    if isinstance(value, pd.DataFrame):
+        return value.to_dict(orient = 'records')
+    if isinstance(value, pd.Series):
+        return value.to_dict()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+class AnalyzerService:
+    """
+    Small asyncio HTTP service answering AnomalyAnalyzer lookups, so that listings can be inspected without a notebook holding the analyzer.
+
+    The analyzer state written by AnomalyAnalyzer.save_state is loaded once at startup, together with its spatial trees and cluster statistics, so every query runs against warm in-memory indices. Queries are computed in a thread pool, so slow requests do not block the event loop. The service only listens on localhost.
+
+    Endpoints (GET, parameters in the query string, JSON responses):
+        /within_radius?row_idx=&radius=
+        /nearby_cluster_prices?row_idx=&radius=
+        /compare_to_nearby_price?row_idx=&radius=
+        /get_loadings?row_idx=&cluster= : loadings of the observation in PCA space, or of its difference from the centroid of the given cluster
+        /stats : number of requests and latency percentiles (ms) for every endpoint
+    radius is in km and defaults to AnomalyAnalyzer.fivemi.
+
+    attributes:
+        analyzer: the AnomalyAnalyzer answering the queries
+        port: port to listen on
+        latencies: dictionary of the most recent latencies (s) of every endpoint
+    """
+    def __init__(self, analyzer, port = 8765, history = 10000):
+        self.analyzer = analyzer
+        self.port = port
+        self.latencies = defaultdict(lambda: deque(maxlen = history))
+        self.routes = {'/within_radius': self.within_radius,
+                       '/nearby_cluster_prices': self.nearby_cluster_prices,
+                       '/compare_to_nearby_price': self.compare_to_nearby_price,
+                       '/get_loadings': self.get_loadings,
+                       '/stats': self.stats}
+
+    @classmethod
+    def from_state(cls, filepath, port = 8765):
+        return cls(AnomalyAnalyzer.load_state(filepath), port = port)
+
+    @staticmethod
+    def _row_and_radius(params):
+        return int(params['row_idx']), float(params.get('radius', AnomalyAnalyzer.fivemi))
+
+    def within_radius(self, params):
+        row_idx, radius = self._row_and_radius(params)
+        return self.analyzer.within_radius(row_idx, radius = radius)
+
+    def nearby_cluster_prices(self, params):
+        row_idx, radius = self._row_and_radius(params)
+        return self.analyzer.nearby_cluster_prices(row_idx, radius = radius)
+
+    def compare_to_nearby_price(self, params):
+        row_idx, radius = self._row_and_radius(params)
+        return self.analyzer.compare_to_nearby_price(row_idx, radius = radius)
+
+    def get_loadings(self, params):
+        row_idx = int(params['row_idx'])
+        vector = self.analyzer.data.loc[row_idx, :]
+        if 'cluster' in params:
+            cluster = self.analyzer.cluster_labels.dtype.type(params['cluster'])
+            vector = vector - self.analyzer.cluster_stats.loc[cluster, list(self.analyzer.data.columns)]
+        return self.analyzer.get_loadings(vector)
+
+    def stats(self, params):
+        return {endpoint: {'count': len(times),
+                           'p50_ms': np.percentile(times, 50) * 1000,
+                           'p90_ms': np.percentile(times, 90) * 1000,
+                           'p99_ms': np.percentile(times, 99) * 1000}
+                for endpoint, times in self.latencies.items() if len(times)}
+
+    def _warm(self):
+        #Build the lazy indices before accepting requests, so they are never built concurrently
+        self.analyzer.coord_tree
+        self.analyzer.feature_tree
+        self.analyzer.cluster_stats
+
+    async def _respond(self, writer, status, body):
+        try:
+            payload = json.dumps(body).encode()
+        except (TypeError, ValueError) as e:
+            status, payload = '500 Internal Server Error', json.dumps({'error': repr(e)}).encode()
+        writer.write(('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'
+                      .format(status, len(payload))).encode() + payload)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            await self._handle(reader, writer)
+        except Exception as e:
+            #Any other failure of a route still gets a JSON reply, instead of an empty response
+            try:
+                await self._respond(writer, '500 Internal Server Error', {'error': repr(e)})
+            except Exception:
+                pass #the client is gone
+        finally:
+            writer.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass #headers are not needed
+            method, target, _ = request_line.split(' ', 2)
+        except ValueError:
+            await self._respond(writer, '400 Bad Request', {'error': 'malformed request'})
+            return
+
+        url = urlsplit(target)
+        route = self.routes.get(url.path)
+        if method != 'GET' or route is None:
+            await self._respond(writer, '404 Not Found', {'error': 'unknown endpoint {}'.format(url.path)})
+            return
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        start = time.perf_counter()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(None, route, params)
+        except (KeyError, ValueError, IndexError) as e:
+            await self._respond(writer, '400 Bad Request', {'error': repr(e)})
+            return
+        if url.path != '/stats':
+            self.latencies[url.path].append(time.perf_counter() - start)
+        await self._respond(writer, '200 OK', to_json(result))
+
+    async def serve(self):
+        self._warm()
+        server = await asyncio.start_server(self.handle, HOST, self.port)
+        print(f'Serving AnomalyAnalyzer queries on http://{HOST}:{self.port}')
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Serve AnomalyAnalyzer lookups on localhost.')
+    parser.add_argument('state', help = 'file written by AnomalyAnalyzer.save_state')
+    parser.add_argument('--port', type = int, default = 8765)
+    args = parser.parse_args()
+    AnalyzerService.from_state(args.state, port = args.port).run()
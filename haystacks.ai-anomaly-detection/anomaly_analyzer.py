@@ -2,10 +2,16 @@ from mapper_clusterer import *
 import pandas as pd
 import numpy as np
 from matplotlib import pyplot as plt
+from matplotlib.colors import ListedColormap
 from geography_helper import *
 from sklearn.metrics import pairwise_distances
+from sklearn.neighbors import KDTree, BallTree
+from scipy.sparse import csr_matrix
 from geography_helper import places_to_geom
 import geopandas as gpd
+import hashlib
+import pickle
+from data_cluster_bundle import DataClusterBundle
 
 class AnomalyAnalyzer:
     @staticmethod
@@ -14,7 +20,7 @@ class AnomalyAnalyzer:
     
     fivemi = 8.04672
     
-    def __init__(self,dcb, features, pca_basis = None, pca_latlong = False):
+    def __init__(self,dcb, features, pca_basis = None, pca_latlong = False, sketch_size = None, compact = False):
         """
         Creates anomaly analysis object. This object has methods for identifying and visualizing anomalies based on the result of a clustering algorithm, as well as for comparing them to similar or nearby clusters.
         
@@ -31,6 +37,10 @@ class AnomalyAnalyzer:
         Must have 'latitude' and 'longitude' columns for creating the maps.
         Must have 'price' column to use any of the methods extracting price.
         
+        sketch_size: optional int. If given, build_price_sketches(sketch_size) is run at initialization, so that price quantiles over unions of clusters can be approximated with approximate = True.
+        
+        compact: if True, the data attribute is kept as a contiguous float32 DataFrame, and labeled_data is composed from the bundle when accessed instead of being kept in memory next to the data. Passing a DataClusterBundle built with compact = True avoids keeping a float64 copy of the data in the bundle. All methods work in compact mode, but values computed from the data (distances, centroids, loadings) only agree with the float64 ones to float32 precision (a relative 1e-6 or so), and neighbour queries may order exact ties differently.
+        
         pca_basis: numpy array of PCA 'loadings'.
         The number of columns must match that of the data stored in the DataClusterBundle, and the rows must match the columns of the 'features' DataFrame (without 'latitude' and 'longitude', unless specified with pca_latlong).
         This matrix should be the basis of the ambient PCA space containing the data in the DataClusterBundle, expressed in the coordinates of the (possibly transformed) original feature DataFrame. In other words, the columns of the matrix should be the images of the coordinate basis vectors (1,0,...), (0,1,0,...) under the inverse PCA transformation. 
@@ -41,19 +51,29 @@ class AnomalyAnalyzer:
         dcb: access the DataClusterBundle passed to the constructor
         data: the data stored in the DataClusterBundle. This is the representation which was passed to the clustering algorithm
         anomalies: DataFrame storing the anomalies using the representation stored in the data attribute
-        labeled_data: the data together with the lat/long and cluster labels
+        labeled_data: the data together with the lat/long and cluster labels. Built on first access, and never stored in compact mode.
         cluster_sizes: DataFrame of the cluster labels and their sizes. Ordered from largest to smallest cluster.
         features: the original features DataFrame passed to the constructor. This is the  representation which was transformed into the one passed to the clustering algorithm.
         coords: DataFrame just of the latitude and longitude of the observations
-        haversine_distances: matrix of geographic distances between all observations
-        distances: matrix of euclidean distance between observations using the representation stored in the data attribute
+        feature_tree: KDTree over the data attribute, used for similar point queries. Built on first use.
+        coord_tree: haversine BallTree over the coordinates, used for radius queries. Built on first use.
+        haversine_distances: matrix of geographic distances between all observations. Computed on first access only, since it takes O(n_samples^2) memory.
+        distances: matrix of euclidean distance between observations using the representation stored in the data attribute. Computed on first access only, since it takes O(n_samples^2) memory.
+        cluster_stats: DataFrame indexed by cluster label with the centroid of each cluster in the representation stored in the data attribute, its size, mean and median price, and lat/long bounding box. Computed on first use, and recomputed after the labels of the bundle change (see refresh_labels).
+        cluster_labels: sorted array of the distinct cluster labels
+        cluster_offsets: array such that the members of cluster_labels[k] are at positions cluster_offsets[k]:cluster_offsets[k+1] of cluster_order
+        cluster_order: positions of the rows of labeled_data, sorted by cluster label
         feature_list: list of feature names (without lat/long, unless specified), in the order they occur in the 'features' DataFrame. Used to align PCA-transformed data with the original features with the pca_basis, if provided.
         
         """
-        #set data, labeled_data, and cluster_sizes attributes from the DataClusterBundle
+        #set data and cluster_sizes attributes from the DataClusterBundle. labeled_data is built when needed
         self.dcb = dcb
-        self.data = dcb.data
-        self.labeled_data = dcb.data_with_labels()
+        self.compact = compact
+        if compact and not all(dcb.data.dtypes == np.float32):
+            self.data = pd.DataFrame(np.ascontiguousarray(dcb.data, dtype = np.float32), index = dcb.data.index, columns = dcb.data.columns)
+        else:
+            self.data = dcb.data
+        self._labeled_data = None
         self.cluster_sizes = self.dcb.get_cluster_sizes()
         
         #Set features, coordinates, and feature_list for the pca loadings from the features DataFrame
@@ -67,14 +87,402 @@ class AnomalyAnalyzer:
         #load pca basis
         self.pca_basis = pca_basis
         
-        #Compute distances
-        self.distances = pairwise_distances(self.data) #distances in pca feature space
-        self.haversine_distances = distances_from_dfs(self.coords,self.coords) #haversine distances
+        #Index of cluster members, so that clusters can be looked up without scanning labeled_data
+        self._build_cluster_index()
+        self._cluster_stats = None
+        self._labels_ref = self._bundle_labels()
+        self._labels_hash = self._hash_labels()
+        
+        #Optional per-cluster price sketches for approximate quantiles
+        self.sketch_size = None
+        self._sketch_request = None
+        if sketch_size:
+            self.build_price_sketches(sketch_size)
+        
+        #Neighbour queries use trees built on first use, instead of dense distance matrices
+        self._feature_tree = None
+        self._coord_tree = None
+        self._distances = None
+        self._haversine_distances = None
         
         #no anomalies at initialization
         self.anomalies = None
         
+    def _bundle_labels(self):
+        #Labels of a DataClusterBundle, or components of a ClusterOverCoords
+        labels = getattr(self.dcb, 'labels', None)
+        if labels is None:
+            labels = getattr(self.dcb, 'components', None)
+        return labels
+    
+    def _hash_labels(self):
+        #Fingerprint of the bundle's labels
+        return hashlib.sha1(np.ascontiguousarray(self._bundle_labels()).tobytes()).hexdigest()
+    
+    def _bundle_coords(self):
+        #Lat/long array of the bundle, which is a DataFrame for a DataClusterBundle and an array for a ClusterOverCoords
+        coords = self.dcb.coords
+        return coords.values if isinstance(coords, pd.DataFrame) else np.asarray(coords)
+    
+    @property
+    def labeled_data(self):
+        self._sync_labels()
+        if self._labeled_data is not None:
+            return self._labeled_data
+        if self.compact:
+            return self._labeled_rows(slice(None))
+        self._labeled_data = self.dcb.data_with_labels()
+        return self._labeled_data
+    
+    def _labeled_rows(self, positions):
+        #Rows of labeled_data at the given positions, composed from the bundle without building all of labeled_data
+        if self._labeled_data is not None:
+            return self._labeled_data.iloc[positions]
+        data = self.data.iloc[positions]
+        coords = pd.DataFrame(self._bundle_coords()[positions], index = data.index, columns = ['latitude', 'longitude'])
+        labels = pd.Series(np.asarray(self._bundle_labels())[positions], index = data.index, name = 'cluster')
+        return pd.concat([coords, data, labels], axis = 1)
+    
+    def save_state(self, filepath):
+        """
+        Pickles what is needed to answer queries without the original bundle: the data, coordinates, labels, features, PCA basis, the spatial trees, and the cluster statistics. The trees and statistics are built first if needed, so an analyzer restored with load_state is warm.
+        """
+        state = {'data': self.data,
+                 'coords': self._bundle_coords(),
+                 'labels': np.asarray(self._bundle_labels()),
+                 'features': self.features,
+                 'pca_basis': self.pca_basis,
+                 'feature_list': self.feature_list,
+                 'sketch_size': self._sketch_request,
+                 'feature_tree': self.feature_tree,
+                 'coord_tree': self.coord_tree,
+                 'cluster_stats': self.cluster_stats,
+                 'compact': self.compact}
+        with open(filepath, 'wb') as f:
+            pickle.dump(state, f, protocol = pickle.HIGHEST_PROTOCOL)
+    
+    @classmethod
+    def load_state(cls, filepath):
+        """
+        Returns an AnomalyAnalyzer restored from a file written by save_state, backed by a DataClusterBundle of the saved data and labels.
+        """
+        with open(filepath, 'rb') as f:
+            state = pickle.load(f)
+        compact = state.get('compact', False)
+        dcb = DataClusterBundle(state['data'], state['coords'], state['labels'], compact = compact)
+        analyzer = cls(dcb, state['features'], pca_basis = state['pca_basis'], sketch_size = state['sketch_size'], compact = compact)
+        analyzer.feature_list = state['feature_list']
+        analyzer._feature_tree = state['feature_tree']
+        analyzer._coord_tree = state['coord_tree']
+        analyzer._cluster_stats = state['cluster_stats']
+        return analyzer
+    
+    def refresh_labels(self):
+        """
+        Rebuilds everything derived from the cluster labels (cluster index, sizes, statistics, and price sketches) if the labels of the bundle changed since they were read.
         
+        Reassigning the labels of the bundle (e.g. dcb.labels = new_labels, or ClusterOverCoords.update) is noticed by every method. Changes made in place to the labels array are only noticed by get_all_anomalies, anomaly_sweep, and this method, which compare the contents of the labels.
+        """
+        self._sync_labels(check_contents = True)
+    
+    def _sync_labels(self, check_contents = False):
+        #Rebuild everything derived from the labels if the bundle's labels changed since they were read.
+        #Every method reading the cluster index calls this first, so by default it only checks in O(1) that the labels object is the same.
+        #The contents are hashed if the object changed or on request. The hash is updated before rebuilding, so nested calls return at once
+        labels = self._bundle_labels()
+        if labels is self._labels_ref and not check_contents:
+            return
+        self._labels_ref = labels
+        labels_hash = self._hash_labels()
+        if labels_hash == self._labels_hash:
+            return
+        self._labels_hash = labels_hash
+        self._labeled_data = None
+        self.cluster_sizes = self.dcb.get_cluster_sizes()
+        self._build_cluster_index()
+        if self._sketch_request:
+            self.build_price_sketches(self._sketch_request)
+        self._cluster_stats = None
+    
+    @property
+    def cluster_stats(self):
+        self._sync_labels()
+        if self._cluster_stats is None:
+            #One groupby over the data for the centroids and sizes, one over the coordinates for the bounding boxes, and one over the prices
+            grouped = self.data.groupby(self._label_series)
+            stats = grouped.mean()
+            stats['size'] = grouped.size()
+            coords = pd.DataFrame(self._bundle_coords(), index = self.data.index, columns = ['latitude', 'longitude'])
+            bounds = coords.groupby(self._label_series).agg(['min', 'max'])
+            bounds.columns = ['lat_min', 'lat_max', 'long_min', 'long_max']
+            stats = stats.join(bounds)
+            if 'price' in self.features.columns:
+                prices = self.features.loc[self.data.index, 'price'].groupby(self._label_series).agg(['mean', 'median'])
+                stats['mean_price'] = prices['mean']
+                stats['median_price'] = prices['median']
+            self._cluster_stats = stats
+        return self._cluster_stats
+    
+    def _cluster_difs(self, row_idx, cluster_list):
+        #Differences between the observation and the centroids of the given clusters, in the representation stored in the data attribute
+        centroids = self.cluster_stats.loc[np.sort(cluster_list), list(self.data.columns)]
+        cluster_difs = pd.DataFrame(np.array(self.data.loc[row_idx,:]).reshape(-1,1) - np.array(centroids.T),
+                           columns = centroids.index)
+        cluster_difs.index = ['PC'+str(x) for x in np.arange(centroids.shape[1])+1]
+        return cluster_difs
+    
+    def _cluster_price_table(self, cluster_list, stat):
+        #Mean or median price of each of the given clusters, with columns 'cluster' and 'price'
+        labels = np.sort(cluster_list)
+        return pd.DataFrame({'cluster': labels, 'price': self.cluster_stats.loc[labels, stat].values})
+    
+    def _build_cluster_index(self):
+        #Rows sorted by cluster label with CSR-style offsets, and the prices in the same order.
+        #The sort is stable, so members of a cluster stay in row order.
+        labels = np.asarray(self._bundle_labels())
+        self._label_series = pd.Series(labels, index = self.data.index, name = 'cluster')
+        self.cluster_order = np.argsort(labels, kind = 'stable')
+        self.cluster_labels, starts = np.unique(labels[self.cluster_order], return_index = True)
+        self.cluster_offsets = np.append(starts, len(labels))
+        self._cluster_codes = np.searchsorted(self.cluster_labels, labels) #position of each row's cluster in cluster_labels
+        self._cluster_position = {label: k for k, label in enumerate(self.cluster_labels)}
+        #Clusters sorted by size, for selecting anomalies by a size window
+        sizes = np.diff(self.cluster_offsets)
+        self._size_order = np.argsort(sizes, kind = 'stable')
+        self._sorted_sizes = sizes[self._size_order]
+        if 'price' in self.features.columns:
+            self._sorted_prices = self.features.loc[self.data.index, 'price'].values[self.cluster_order]
+        else:
+            self._sorted_prices = None
+    
+    def cluster_rows(self, cluster_label):
+        """
+        Returns the positions in labeled_data of all rows in a cluster, in row order.
+        """
+        self._sync_labels()
+        k = self._cluster_position.get(cluster_label)
+        if k is None:
+            return np.array([], dtype = int)
+        return self.cluster_order[self.cluster_offsets[k]:self.cluster_offsets[k+1]]
+    
+    def _clusters_of_points(self, points):
+        #Cluster labels of the given rows, without repeats, in order of first appearance
+        self._sync_labels()
+        return pd.unique(self._label_series.loc[points].values)
+    
+    def _rows_in_clusters(self, cluster_list):
+        #Subset of labeled_data in any of the given clusters
+        positions = [self.cluster_rows(label) for label in cluster_list]
+        positions = np.concatenate(positions) if positions else np.array([], dtype = int)
+        return self._labeled_rows(positions).drop_duplicates()
+    
+    def _point_cluster_matrix(self):
+        #Sparse (n_samples, n_clusters) matrix with a 1 at each row's cluster
+        self._sync_labels()
+        n = len(self._cluster_codes)
+        return csr_matrix((np.ones(n, dtype = np.int32), (np.arange(n), self._cluster_codes)),
+                          shape = (n, len(self.cluster_labels)))
+    
+    @staticmethod
+    def _concat_ranges(starts, sizes):
+        #Concatenation of the ranges starts[j]:starts[j]+sizes[j], without a Python loop
+        shift = np.repeat(starts - np.concatenate([[0], np.cumsum(sizes)[:-1]]), sizes)
+        return shift + np.arange(sizes.sum())
+    
+    def _union_prices(self, cluster_sets):
+        #Given a csr matrix whose row i marks a set of clusters, returns the prices of all houses
+        #in those clusters and the row i each price belongs to
+        self._sync_labels()
+        codes = cluster_sets.indices
+        group_of_code = np.repeat(np.arange(cluster_sets.shape[0]), np.diff(cluster_sets.indptr))
+        sizes = np.diff(self.cluster_offsets)[codes]
+        positions = self._concat_ranges(self.cluster_offsets[codes], sizes)
+        return self._sorted_prices[positions], np.repeat(group_of_code, sizes)
+    
+    def build_price_sketches(self, sketch_size = 64):
+        """
+        Builds a mergeable price sketch for every cluster. Clusters with at most sketch_size houses keep their exact sorted prices. Larger clusters are summarized by sketch_size prices at evenly spaced ranks, each weighted by the number of houses it stands for.
+        
+        Sketches of any union of clusters are merged by sorting their weighted prices, and a quantile is read off by interpolating between the ranks the prices stand for. Each summarized cluster of n_c houses shifts ranks by at most n_c / sketch_size, so for a union of N houses the approximate 'quant' quantile lies between the exact quantiles at quant -/+ 1/sketch_size (and is exact when every cluster in the union is small). Sums and counts are kept exactly, so mean prices are not approximated.
+        
+        args:
+            sketch_size: number of prices kept per cluster
+        """
+        sizes = np.diff(self.cluster_offsets)
+        codes = np.repeat(np.arange(len(sizes)), sizes)
+        prices = self._sorted_prices[np.lexsort((self._sorted_prices, codes))]
+        
+        #Ranks kept in each cluster: all of them for small clusters, sketch_size evenly spaced ones otherwise
+        kept = np.minimum(sizes, sketch_size)
+        cluster_of_kept = np.repeat(np.arange(len(sizes)), kept)
+        j = np.arange(kept.sum()) - np.repeat(np.concatenate([[0], np.cumsum(kept)[:-1]]), kept)
+        cluster_sizes = sizes[cluster_of_kept]
+        step = cluster_sizes / kept[cluster_of_kept]
+        ranks = np.where(cluster_sizes > sketch_size, np.floor((j + 0.5) * step).astype(int), j)
+        
+        self.sketch_size = sketch_size
+        self._sketch_request = sketch_size #rebuilt with the same size when the labels change
+        self._sketch_offsets = np.concatenate([[0], np.cumsum(kept)])
+        self._sketch_values = prices[self.cluster_offsets[cluster_of_kept] + ranks]
+        self._sketch_weights = step
+        self._cluster_sums = np.bincount(codes, weights = self._sorted_prices, minlength = len(sizes))
+    
+    def _grouped_sketch_quantile(self, cluster_sets, quant):
+        #Approximate 'quant' quantile of the prices in the union of each row's clusters, from the merged sketches
+        self._sync_labels()
+        n_groups = cluster_sets.shape[0]
+        codes = cluster_sets.indices
+        group_of_code = np.repeat(np.arange(n_groups), np.diff(cluster_sets.indptr))
+        kept = np.diff(self._sketch_offsets)[codes]
+        positions = self._concat_ranges(self._sketch_offsets[codes], kept)
+        values = self._sketch_values[positions]
+        weights = self._sketch_weights[positions]
+        group = np.repeat(group_of_code, kept)
+        
+        order = np.lexsort((values, group))
+        values, weights, group = values[order], weights[order], group[order]
+        #Rank each kept price stands for: the middle of the ranks it summarizes within the merged union
+        cumulative = np.cumsum(weights)
+        totals = np.bincount(group, weights = weights, minlength = n_groups)
+        before_group = np.concatenate([[0], np.cumsum(totals)[:-1]])
+        centers = cumulative - before_group[group] - (weights + 1) / 2
+        
+        #Interpolate at rank quant * (N - 1) in every group with one searchsorted, offsetting the groups
+        spread = totals.max() + 1 if n_groups else 1
+        keys = group * spread + centers
+        targets = np.arange(n_groups) * spread + quant * (totals - 1)
+        counts = np.bincount(group, minlength = n_groups)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        upper = np.clip(np.searchsorted(keys, targets), starts, starts + counts - 1)
+        lower = np.clip(upper - 1, starts, starts + counts - 1)
+        result = np.full(n_groups, np.nan)
+        nonempty = counts > 0
+        lo, hi = lower[nonempty], upper[nonempty]
+        width = keys[hi] - keys[lo]
+        t = np.where(width > 0, (targets[nonempty] - keys[lo]) / np.where(width > 0, width, 1), 0)
+        t = np.clip(t, 0, 1)
+        result[nonempty] = values[lo] + (values[hi] - values[lo]) * t
+        return result
+    
+    def union_price_quantile(self, cluster_list, quant, approximate = False):
+        """
+        Returns the 'quant' quantile of price among all houses in the given clusters. With approximate = True, the quantile is read from the merged cluster sketches (see build_price_sketches), which must have been built.
+        """
+        self._sync_labels()
+        codes = np.unique([self._cluster_position[label] for label in cluster_list])
+        cluster_sets = csr_matrix((np.ones(len(codes)), codes, [0, len(codes)]), shape = (1, len(self.cluster_labels)))
+        if approximate:
+            return self._grouped_sketch_quantile(cluster_sets, quant)[0]
+        return np.quantile(np.concatenate([self.cluster_price(label) for label in cluster_list]), quant)
+    
+    @staticmethod
+    def _grouped_quantile(values, group, n_groups, quant):
+        #np.quantile (linear method) of the values in each group, for all groups at once
+        order = np.lexsort((values, group))
+        values = values[order]
+        counts = np.bincount(group, minlength = n_groups)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        virtual = quant * (counts - 1)
+        lower = np.floor(virtual).astype(int)
+        upper = np.minimum(lower + 1, counts - 1)
+        t = virtual - lower
+        result = np.full(n_groups, np.nan)
+        nonempty = counts > 0
+        a = values[(starts + lower)[nonempty]]
+        b = values[(starts + upper)[nonempty]]
+        t = t[nonempty]
+        #same interpolation as numpy, which counts from the upper value when t >= 0.5
+        diff = b - a
+        result[nonempty] = np.where(t >= 0.5, b - diff * (1 - t), a + diff * t)
+        #np.quantile is nan for any group containing a nan
+        has_nan = np.bincount(group, weights = np.isnan(values[np.argsort(order)]), minlength = n_groups) > 0
+        result[has_nan] = np.nan
+        return result
+    
+    @staticmethod
+    def _grouped_median(values, group, n_groups):
+        #Median of the values in each group, averaging the two middle values for even sizes
+        values = values[np.lexsort((values, group))]
+        counts = np.bincount(group, minlength = n_groups)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        result = np.full(n_groups, np.nan)
+        nonempty = counts > 0
+        lower = values[(starts + (counts - 1) // 2)[nonempty]]
+        upper = values[(starts + counts // 2)[nonempty]]
+        result[nonempty] = (lower + upper) / 2
+        return result
+    
+    def _price_comparison(self, anomaly_idx, cluster_sets, quant, approximate = False):
+        #Shared by the batch reports: compares each anomaly to the houses in the union of its set of clusters
+        self._sync_labels()
+        n_anomalies = len(anomaly_idx)
+        if approximate:
+            if self.sketch_size is None:
+                raise ValueError('Run build_price_sketches before using approximate quantiles')
+            in_set = csr_matrix((np.ones(len(cluster_sets.indices)), cluster_sets.indices, cluster_sets.indptr), shape = cluster_sets.shape)
+            counts = (in_set @ np.diff(self.cluster_offsets)).astype(int)
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                mean_price = (in_set @ self._cluster_sums) / counts
+            quantile_price = self._grouped_sketch_quantile(cluster_sets, quant)
+        else:
+            prices, group = self._union_prices(cluster_sets)
+            counts = np.bincount(group, minlength = n_anomalies)
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                mean_price = np.bincount(group, weights = prices, minlength = n_anomalies) / counts
+            quantile_price = self._grouped_quantile(prices, group, n_anomalies, quant)
+        price = self.features['price'].values[anomaly_idx]
+        return {'data_idx': anomaly_idx,
+                'price': price,
+                'clusters': [self.cluster_labels[cluster_sets.indices[cluster_sets.indptr[i]:cluster_sets.indptr[i+1]]] for i in range(n_anomalies)],
+                'n_houses': counts,
+                'quantile_price': quantile_price,
+                'mean_price': mean_price,
+                'price_dif': price - mean_price,
+                'cheaper': price <= quantile_price}
+    
+    @property
+    def feature_tree(self):
+        if self._feature_tree is None:
+            self._feature_tree = KDTree(np.asarray(self.data))
+        return self._feature_tree
+    
+    @property
+    def coord_tree(self):
+        if self._coord_tree is None:
+            self._coord_tree = BallTree(lat_long_rad(self.coords), metric = 'haversine')
+        return self._coord_tree
+    
+    @property
+    def distances(self):
+        if self._distances is None:
+            self._distances = pairwise_distances(self.data) #distances in pca feature space
+        return self._distances
+    
+    @property
+    def haversine_distances(self):
+        if self._haversine_distances is None:
+            self._haversine_distances = distances_from_dfs(self.coords,self.coords) #haversine distances
+        return self._haversine_distances
+    
+    
+    @property
+    def na_mask(self):
+        """
+        Boolean array which is True for the rows of features containing a missing (e.g. imputed) value. Same as contains_na, for all rows at once.
+        """
+        if getattr(self, '_na_mask', None) is None:
+            self._na_mask = self.features.isna().any(axis = 1).values
+        return self._na_mask
+    
+    def _anomaly_positions(self, lower_threshold, upper_threshold):
+        #Positions in labeled_data of the rows in clusters whose size is in the window, in row order.
+        #The clusters in the window are a slice of the clusters sorted by size.
+        self._sync_labels()
+        start = np.searchsorted(self._sorted_sizes, lower_threshold, side = 'left')
+        stop = max(start, np.searchsorted(self._sorted_sizes, upper_threshold, side = 'right'))
+        codes = self._size_order[start:stop]
+        positions = self._concat_ranges(self.cluster_offsets[codes], np.diff(self.cluster_offsets)[codes])
+        return np.sort(self.cluster_order[positions]), stop - start
     
     def get_all_anomalies(self, lower_threshold, upper_threshold, drop_imputed=False):
         """
@@ -82,16 +490,38 @@ class AnomalyAnalyzer:
         
         When the method is run, those observations get stored in the 'anomalies' attribute.
         """
-        cluster_sizes = self.cluster_sizes
-        spare_clusters = list(cluster_sizes[(cluster_sizes.n_members <= upper_threshold) 
-                                            & (cluster_sizes.n_members >= lower_threshold)]['cluster_label'].values)
-        labeled_data = self.labeled_data
-        anomalies = labeled_data[labeled_data.cluster.isin(spare_clusters)].reset_index().rename({'index':'data_idx'}, axis = 1)  
+        self._sync_labels(check_contents = True)
+        positions, _ = self._anomaly_positions(lower_threshold, upper_threshold)
+        anomalies = self._labeled_rows(positions).reset_index().rename({'index':'data_idx'}, axis = 1)  
         if not drop_imputed:
             self.anomalies =  anomalies
         else:
-            anomaly_indices = list(anomalies['data_idx'])
-            self.anomalies = anomalies[pd.Series([*map(lambda x: ~self.contains_na(self.features, x), anomaly_indices)])]
+            self.anomalies = anomalies[~self.na_mask[anomalies['data_idx'].values]]
+    
+    def anomaly_sweep(self, lower_thresholds, upper_thresholds, drop_imputed=False):
+        """
+        Runs the selection of get_all_anomalies for every pair of lower and upper thresholds with lower <= upper, without changing the 'anomalies' attribute. Useful to choose the size window of the anomalies.
+        
+        args:
+            lower_thresholds, upper_thresholds: iterables of cluster sizes
+            drop_imputed: whether rows with imputed values are excluded, as in get_all_anomalies
+        returns:
+            DataFrame with one row per pair and columns 'lower_threshold', 'upper_threshold', 'n_clusters' (number of clusters in the window), 'n_anomalies', and 'data_idx' (array of row indices of the anomalies)
+        """
+        self._sync_labels(check_contents = True)
+        index = self.data.index.values
+        rows = []
+        for lower_threshold in lower_thresholds:
+            for upper_threshold in upper_thresholds:
+                if lower_threshold > upper_threshold:
+                    continue
+                positions, n_clusters = self._anomaly_positions(lower_threshold, upper_threshold)
+                data_idx = index[positions]
+                if drop_imputed:
+                    data_idx = data_idx[~self.na_mask[data_idx]]
+                rows.append({'lower_threshold': lower_threshold, 'upper_threshold': upper_threshold,
+                             'n_clusters': n_clusters, 'n_anomalies': len(data_idx), 'data_idx': data_idx})
+        return pd.DataFrame(rows)
             
 #General information extraction methods
 
@@ -108,9 +538,11 @@ class AnomalyAnalyzer:
         args:
             cluster_label: label from the 'cluster' column of the labeled_data
         """
-        in_cluster = list(self.labeled_data[self.labeled_data['cluster'] 
-                                            == cluster_label].index)
-        return self.features.loc[in_cluster,'price'].values
+        self._sync_labels()
+        k = self._cluster_position.get(cluster_label)
+        if k is None:
+            return self.features['price'].values[:0]
+        return self._sorted_prices[self.cluster_offsets[k]:self.cluster_offsets[k+1]]
             
 
 
@@ -125,9 +557,13 @@ class AnomalyAnalyzer:
             row_idx: index of the observation
             n: the number of similar observations to be found
         returns:
-            indices of the n most similar observations
+            indices of the n most similar observations, from most to least similar
         """
-        return self.distances[row_idx,:].argsort()[1:n+1]
+        x = np.asarray(self.data)[[row_idx]]
+        _, ind = self.feature_tree.query(x, k = min(n + 1, self.data.shape[0]))
+        ind = ind[0]
+        #the observation itself is excluded, even if it ties with a duplicate
+        return np.concatenate([ind[ind != row_idx], ind[ind == row_idx]])[:n]
     
     def similar_point_clusters(self, row_idx, n=1):
         """
@@ -140,13 +576,7 @@ class AnomalyAnalyzer:
             Subset of the labeled_data DataFrame of observations in the same cluster as one of the simlar observations.
         """
         close_points = self.get_similar_points(row_idx, n=n)
-        close_clusters = []
-        for point in close_points:
-            close_cluster_label = self.labeled_data.loc[point, 'cluster']
-            close_cluster = self.labeled_data[self.labeled_data['cluster'] == close_cluster_label]
-            close_clusters.append(close_cluster)
-            
-        return pd.concat(close_clusters, axis = 0).drop_duplicates()
+        return self._rows_in_clusters(self._clusters_of_points(close_points))
     
     def dif_from_clusters(self, row_idx, n = 1):
         """
@@ -158,18 +588,10 @@ class AnomalyAnalyzer:
         returns:
             DataFrame of differences observation - cluster mean for each cluster containing a similar observation.
         """
-        in_cluster = self.labeled_data.loc[row_idx,'cluster']
+        self._sync_labels()
+        in_cluster = self._label_series.loc[row_idx]
         print(f'Given point is in cluster {in_cluster}')
-        cluster_means = self.similar_point_clusters(row_idx, n=n).groupby('cluster').mean()
-        try:
-            cluster_means.drop(['latitude', 'longitude'], axis = 1, inplace = True)
-        except:
-            pass
-        cluster_difs = pd.DataFrame(np.array(self.data.loc[row_idx,:]).reshape(-1,1) - 
-                                    np.array(cluster_means.T) ,
-                           columns = cluster_means.index)
-        cluster_difs.index = ['PC'+str(x) for x in np.arange(cluster_means.shape[1])+1]
-        return cluster_difs
+        return self._cluster_difs(row_idx, self._clusters_of_points(self.get_similar_points(row_idx, n=n)))
     
     def similar_cluster_prices(self, row_idx, n = 1):
         """
@@ -181,9 +603,7 @@ class AnomalyAnalyzer:
         returns:
             DataFrame of clusters containing one of the n observations most similar to the given observation, together with the average price of each cluster.
         """
-        similar_clusters = self.similar_point_clusters(row_idx, n = n)
-        return pd.concat([self.features.loc[similar_clusters.index,'price'], 
-           similar_clusters['cluster']], axis = 1).groupby('cluster').mean().reset_index() 
+        return self._cluster_price_table(self._clusters_of_points(self.get_similar_points(row_idx, n = n)), 'mean_price')
     
     def similar_cluster_prices_median(self, row_idx, n = 1):
         """
@@ -195,24 +615,73 @@ class AnomalyAnalyzer:
         returns:
             DataFrame of clusters containing one of the n observations most similar to the given observation, together with the median price of each cluster.
         """
-        similar_clusters = self.similar_point_clusters(row_idx, n = n)
-        return pd.concat([self.features.loc[similar_clusters.index,'price'], 
-           similar_clusters['cluster']], axis = 1).groupby('cluster').median().reset_index() 
+        return self._cluster_price_table(self._clusters_of_points(self.get_similar_points(row_idx, n = n)), 'median_price')
     
-    def significantly_cheaper_than_similar_houses(self, n =1, quant = 0.025):
+    def significantly_cheaper_than_similar_houses(self, n =1, quant = 0.025, approximate = False):
         """
         Out of all the anomalies, returns those which are at least as cheap the house at the 2.5%ile amongst those in clusters containing one similar to it. Ideally, finds anomalies which are significantly cheaper than houses in the clusters it is most similar to.
         
         args:
             n: number of similar houses to look for for each anomaly
             quant: the price percentile that an anomaly must be at among similar houses to be considered "cheap"
+            approximate: if True, quantiles come from the cluster price sketches (see build_price_sketches)
         returns:
             list of indices of anomalies which are significantly cheaper than those in clusters with similar houses
         """
-        similar_prices = lambda indx: np.concatenate([self.cluster_price(x) for x in
-                            self.similar_point_clusters(indx, n = n)['cluster'].unique()])
-        return [row_idx for row_idx in list(self.anomalies['data_idx'])
-                if self.house_price(row_idx) <= np.quantile(similar_prices(row_idx), quant)]
+        report = self.similar_price_report(n = n, quant = quant, approximate = approximate)
+        return list(report.loc[report['cheaper'], 'data_idx'])
+    
+    def similar_price_report(self, n = 1, quant = 0.025, approximate = False):
+        """
+        Compares every anomaly to the clusters containing one of its n most similar houses at once. The similar houses of all anomalies come from one query of the feature tree, and are mapped to sets of clusters through a sparse point by cluster matrix.
+        
+        args:
+            n: number of similar houses to look for for each anomaly
+            quant: the price percentile that an anomaly must be at among similar houses to be considered "cheap"
+            approximate: if True, quantiles come from the cluster price sketches (see build_price_sketches)
+        returns:
+            DataFrame with one row per anomaly and columns:
+                data_idx: row index of the anomaly
+                price: price of the anomaly
+                similar_clusters: array of labels of the clusters containing a similar house
+                cluster_mean_prices: array of the average price of each similar cluster, as in similar_cluster_prices
+                cluster_median_prices: array of the median price of each similar cluster, as in similar_cluster_prices_median
+                n_similar: number of houses in the similar clusters
+                quantile_price: the 'quant' quantile of price among houses in the similar clusters
+                mean_price: average price of houses in the similar clusters
+                price_dif: price - mean_price, as in compare_price_to_similar
+                cheaper: whether price <= quantile_price
+        """
+        self._sync_labels()
+        anomaly_idx = self.anomalies['data_idx'].values
+        n_anomalies = len(anomaly_idx)
+        n = min(n, self.data.shape[0] - 1)
+        
+        #n+1 nearest neighbours of every anomaly, without the anomaly itself.
+        #With no anomalies or no other observations, every anomaly has no similar house
+        if n_anomalies and n > 0:
+            _, ind = self.feature_tree.query(np.asarray(self.data)[anomaly_idx], k = n + 1)
+            keep = ind != anomaly_idx[:, None]
+            keep[keep.all(axis = 1), -1] = False #ties can push the anomaly itself out of the neighbours
+            ind = ind[keep].reshape(n_anomalies, n)
+        else:
+            ind = np.empty((n_anomalies, 0), dtype = int)
+        
+        S = csr_matrix((np.ones(ind.size, dtype = np.int32), ind.ravel(), np.arange(n_anomalies + 1) * ind.shape[1]),
+                       shape = (n_anomalies, self.coords.shape[0]))
+        similar = (S @ self._point_cluster_matrix()).tocsr()
+        similar.sort_indices()
+        
+        #Mean and median price of every cluster, each computed once
+        codes = np.repeat(np.arange(len(self.cluster_labels)), np.diff(self.cluster_offsets))
+        sizes = np.diff(self.cluster_offsets)
+        cluster_means = np.bincount(codes, weights = self._sorted_prices, minlength = len(sizes)) / sizes
+        cluster_medians = self._grouped_median(self._sorted_prices, codes, len(sizes))
+        
+        report = pd.DataFrame(self._price_comparison(anomaly_idx, similar, quant, approximate))
+        report.insert(3, 'cluster_mean_prices', [cluster_means[similar.indices[similar.indptr[i]:similar.indptr[i+1]]] for i in range(n_anomalies)])
+        report.insert(4, 'cluster_median_prices', [cluster_medians[similar.indices[similar.indptr[i]:similar.indptr[i+1]]] for i in range(n_anomalies)])
+        return report.rename({'clusters': 'similar_clusters', 'n_houses': 'n_similar'}, axis = 1)
     
     def compare_price_to_similar(self, row_idx, n =1):
         """
@@ -241,8 +710,9 @@ class AnomalyAnalyzer:
         returns:
             NumPy array of indices of houses within the radius of the house at row_idx.
         """
-        distances = self.haversine_distances[row_idx,:]
-        return np.where(distances <= radius)[0]
+        x = lat_long_rad(self.coords.iloc[[row_idx]])
+        ind = self.coord_tree.query_radius(x, r = radius * 1000/6371000)[0]
+        return np.sort(ind)
     
     def clusters_within_radius(self, row_idx, radius = fivemi):
         """
@@ -256,29 +726,17 @@ class AnomalyAnalyzer:
         
         """
         close_points = self.within_radius(row_idx, radius = radius)
-        close_clusters = []
-        for point in close_points:
-            close_cluster_label = self.labeled_data.loc[point, 'cluster']
-            close_cluster = self.labeled_data[self.labeled_data['cluster'] == close_cluster_label]
-            close_clusters.append(close_cluster)
-        return pd.concat(close_clusters, axis = 0).drop_duplicates()
+        return self._rows_in_clusters(self._clusters_of_points(close_points))
     
     def dif_from_clusters_in_radius(self, row_idx, radius = fivemi):
         """
         Shows how point differs from mean of clusters, out of
         those clusters containing the points within radius of the given point
         """
-        in_cluster = self.labeled_data.loc[row_idx,'cluster']
+        self._sync_labels()
+        in_cluster = self._label_series.loc[row_idx]
         print(f'Given point is in cluster {in_cluster}')
-        cluster_means = self.clusters_within_radius(row_idx, radius=radius).groupby('cluster').mean()
-        try:
-            cluster_means.drop(['latitude', 'longitude'], axis = 1, inplace = True)
-        except:
-            pass
-        cluster_difs = pd.DataFrame(np.array(self.data.loc[row_idx,:]).reshape(-1,1) - np.array(cluster_means.T),
-                           columns = cluster_means.index).reset_index(drop=True)
-        cluster_difs.index = ['PC'+str(x) for x in np.arange(cluster_means.shape[1])+1]
-        return cluster_difs
+        return self._cluster_difs(row_idx, self._clusters_of_points(self.within_radius(row_idx, radius = radius)))
     
     def nearby_cluster_prices(self, row_idx, radius =fivemi):
         """
@@ -290,9 +748,7 @@ class AnomalyAnalyzer:
         returns:
             DataFrame of average price for each cluster containing a house within the radius. One column contains the cluster label, and the other the average price.
         """
-        nearby_clusters = self.clusters_within_radius(row_idx, radius = radius)
-        return pd.concat([self.features.loc[nearby_clusters.index,'price'], 
-           nearby_clusters['cluster']], axis = 1).groupby('cluster').mean().reset_index()
+        return self._cluster_price_table(self._clusters_of_points(self.within_radius(row_idx, radius = radius)), 'mean_price')
     
     
     def nearby_cluster_prices_median(self, row_idx, radius =fivemi):
@@ -305,27 +761,106 @@ class AnomalyAnalyzer:
         returns:
             DataFrame of median price for each cluster containing a house within the radius. One column contains the cluster label, and the other the median price.
         """
-        nearby_clusters = self.clusters_within_radius(row_idx, radius = radius)
-        return pd.concat([self.features.loc[nearby_clusters.index,'price'], 
-           nearby_clusters['cluster']], axis = 1).groupby('cluster').median().reset_index()
+        return self._cluster_price_table(self._clusters_of_points(self.within_radius(row_idx, radius = radius)), 'median_price')
     
 
-    def significantly_cheaper_than_nearby_houses(self, radius =fivemi, quant = 0.025):
+    def nearby_price_report(self, radius =fivemi, quant = 0.025, approximate = False):
+        """
+        Compares every anomaly to the houses in its nearby clusters at once, where a nearby cluster is any cluster containing a house within the radius of the anomaly. The radius neighbourhoods of all anomalies come from one query of the coordinate tree, and are mapped to sets of clusters through a sparse point by cluster matrix.
+        
+        args:
+            radius: distance in km
+            quant: float representing quantile
+            approximate: if True, quantiles come from the cluster price sketches (see build_price_sketches)
+        returns:
+            DataFrame with one row per anomaly and columns:
+                data_idx: row index of the anomaly
+                price: price of the anomaly
+                nearby_clusters: array of labels of the nearby clusters
+                n_nearby: number of houses in the nearby clusters
+                quantile_price: the 'quant' quantile of price among houses in the nearby clusters
+                mean_price: average price of houses in the nearby clusters
+                price_dif: price - mean_price, as in compare_to_nearby_price
+                cheaper: whether price <= quantile_price
+        """
+        anomaly_idx = self.anomalies['data_idx'].values
+        n_anomalies = len(anomaly_idx)
+        
+        #anomaly by point matrix of radius neighbourhoods, then anomaly by cluster. The tree cannot be queried with no points
+        neighbours = self.coord_tree.query_radius(lat_long_rad(self.coords.iloc[anomaly_idx]), r = radius * 1000/6371000) if n_anomalies else []
+        indptr = np.concatenate([[0], np.cumsum([len(x) for x in neighbours])])
+        indices = np.concatenate(neighbours) if n_anomalies else np.array([], dtype = int)
+        R = csr_matrix((np.ones(len(indices), dtype = np.int32), indices, indptr), shape = (n_anomalies, self.coords.shape[0]))
+        nearby = (R @ self._point_cluster_matrix()).tocsr()
+        nearby.sort_indices()
+        
+        report = pd.DataFrame(self._price_comparison(anomaly_idx, nearby, quant, approximate))
+        return report.rename({'clusters': 'nearby_clusters', 'n_houses': 'n_nearby'}, axis = 1)
+    
+    def nearby_price_sweep(self, radii, quant = 0.025, approximate = False):
+        """
+        Runs nearby_price_report at several radii. The coordinate tree is queried once at the largest radius with the neighbours sorted by distance, and each nearby cluster is recorded with the distance at which it is first reached. The nearby clusters at any smaller radius are then those first reached within it, so no neighbourhood is recomputed.
+        
+        Only the neighbour query is shared between the radii: the prices of the union of nearby clusters are still gathered and compared from scratch at every radius, so that work grows with the number of radii.
+        
+        args:
+            radii: iterable of distances in km
+            quant: float representing quantile
+            approximate: if True, quantiles come from the cluster price sketches (see build_price_sketches)
+        returns:
+            DataFrame with one row per anomaly and radius, with columns 'radius', 'data_idx', 'price', 'n_nearby', 'quantile_price', 'mean_price', 'price_dif', and 'cheaper', as in nearby_price_report
+        """
+        self._sync_labels()
+        radii = sorted(radii)
+        if not radii:
+            return pd.DataFrame(columns = ['radius', 'data_idx', 'price', 'n_nearby', 'quantile_price', 'mean_price', 'price_dif', 'cheaper'])
+        anomaly_idx = self.anomalies['data_idx'].values
+        n_anomalies = len(anomaly_idx)
+        n_clusters = len(self.cluster_labels)
+        
+        #The tree cannot be queried with no points
+        neighbours, distances = [], []
+        if n_anomalies:
+            neighbours, distances = self.coord_tree.query_radius(lat_long_rad(self.coords.iloc[anomaly_idx]),
+                                                                 r = radii[-1] * 1000/6371000,
+                                                                 return_distance = True, sort_results = True)
+        anomaly_of = np.repeat(np.arange(n_anomalies), [len(x) for x in neighbours])
+        points = np.concatenate(neighbours) if n_anomalies else np.array([], dtype = int)
+        dist = (np.concatenate(distances) if n_anomalies else np.array([])) * 6371000/1000
+        
+        #Distance at which each anomaly first reaches each of its nearby clusters
+        key = anomaly_of * n_clusters + self._cluster_codes[points]
+        order = np.lexsort((dist, key))
+        key, dist = key[order], dist[order]
+        first = np.concatenate([[True], key[1:] != key[:-1]]) if len(key) else np.array([], dtype = bool)
+        key, reached_at = key[first], dist[first]
+        
+        reports = []
+        for radius in radii:
+            within = reached_at <= radius
+            rows, codes = np.divmod(key[within], n_clusters)
+            nearby = csr_matrix((np.ones(len(codes), dtype = np.int32), (rows, codes)), shape = (n_anomalies, n_clusters))
+            nearby.sort_indices()
+            report = pd.DataFrame(self._price_comparison(anomaly_idx, nearby, quant, approximate))
+            report = report.drop('clusters', axis = 1).rename({'n_houses': 'n_nearby'}, axis = 1)
+            report.insert(0, 'radius', radius)
+            reports.append(report)
+        return pd.concat(reports, ignore_index = True)
+    
+    def significantly_cheaper_than_nearby_houses(self, radius =fivemi, quant = 0.025, approximate = False):
         """
         Find the row indexes of all anomalies which are in the bottom 'quant' quantile of price among all houses in a nearby cluster, where a nearby cluster is any cluster containing a house within the radius of the anomaly.
         
         args:
             radius: distance in km
             quant: float representing quantile
+            approximate: if True, quantiles come from the cluster price sketches (see build_price_sketches)
         returns:
             list of row indices of anomalies which are within the lower quantile of prices among all houses in the nearby clusters.
         
         """
-        nearby_prices = lambda indx: np.concatenate([self.cluster_price(x) for x in
-                            self.clusters_within_radius(indx, radius = radius)['cluster'].unique()])
-        
-        return [row_idx for row_idx in list(self.anomalies['data_idx'])\
-                if self.house_price(row_idx) <= np.quantile(nearby_prices(row_idx), quant)]
+        report = self.nearby_price_report(radius = radius, quant = quant, approximate = approximate)
+        return list(report.loc[report['cheaper'], 'data_idx'])
     
     def compare_to_nearby_price(self, row_idx, radius =fivemi):
         """
@@ -343,7 +878,7 @@ class AnomalyAnalyzer:
 
 # Plotting methods
 
-    def map_anomalies(self, map_shape, title = None, fig = None, ax = None, **kwargs):
+    def map_anomalies(self, map_shape, title = None, fig = None, ax = None, raster = False, how = 'count', bins = 500, **kwargs):
         """
         Plots the anomalies on a map. 
         
@@ -351,14 +886,28 @@ class AnomalyAnalyzer:
             map_shape = shape which can be used as geopandas geometry, given in lat/long
             title = string for title
             fig, ax = optionally pass matplotlib figure and axes objects to plot on a given axis
+            raster = if True, bins the anomalies into a grid instead of drawing each point (see plot_raster_map), which is much faster for many points
+            how = with raster, color cells by 'count', mean 'price', or most common cluster 'label'
+            bins = with raster, number of cells along each axis
         
-        Plots the image using geopandas.
+        Plots the image using geopandas, or imshow with raster = True.
         """
         
         #Create figure if fig, ax not passed
         if (not fig) or (not ax):
             fig,ax = plt.subplots(figsize = (10,10))
         
+        if raster:
+            values = {'count': None,
+                      'price': lambda: self.features['price'].values[self.anomalies['data_idx'].values],
+                      'label': lambda: self.anomalies['cluster'].values}[how]
+            plot_raster_map(self.anomalies['latitude'], self.anomalies['longitude'], values = values() if values else None,
+                            how = 'mean' if how == 'price' else how, boundary = map_shape, bins = bins, ax = ax, **kwargs)
+            if title:
+                plt.title(title)
+            plt.axis('off')
+            return
+        
         #Plot background map shape
         boundary = gpd.GeoDataFrame(data = pd.DataFrame({'shape':['shape1']}), 
                                     geometry = [map_shape])
@@ -374,7 +923,7 @@ class AnomalyAnalyzer:
     def map_single_and_clusters(self, single, clusters, map_shape, 
                                 single_color = 'blue', single_alpha = .5, 
                                 cluster_color = 'orange', cluster_alpha = .5, 
-                                fig = None, ax = None, title = None):
+                                fig = None, ax = None, title = None, raster = False, bins = 500):
         
         """Plot a single data point on the map together with a given cluster.
         
@@ -382,43 +931,64 @@ class AnomalyAnalyzer:
             single: row index of the point in data
             cluster: cluster label
             map_shape = shape which can be used as geopandas geometry, given in lat/long
+            raster = if True, bins the cluster members into a grid instead of drawing each point, which is much faster for large clusters
+            bins = with raster, number of cells along each axis
         
-        Plots the image using geopandas.
+        Plots the image using geopandas, or imshow with raster = True.
         """
         
         #Create figure if fig, ax not passed
         if (not fig) or (not ax):
             fig,ax = plt.subplots(figsize = (10,10))
         
+        #Rows of the clusters and of the point, composed without building all of labeled_data
+        members = self._labeled_rows(np.unique(np.concatenate([self.cluster_rows(x) for x in clusters] + [np.array([], dtype = int)])))
+        points = self._labeled_rows(np.flatnonzero(self.data.index == single))
+        
+        if raster:
+            plot_raster_map(members['latitude'], members['longitude'], boundary = map_shape, bins = bins, ax = ax,
+                            cmap = ListedColormap([cluster_color]), alpha = cluster_alpha)
+            ax.scatter(points['longitude'], points['latitude'], color = single_color, alpha = single_alpha)
+            if title:
+                plt.title(title)
+            plt.axis('off')
+            return
+        
         #Plot background map shape
         boundary = gpd.GeoDataFrame(data = pd.DataFrame({'shape':['shape1']}), 
                                     geometry = [map_shape])
         boundary.plot(ax =ax, alpha = .5)
         
         #plot cluster
-        places_to_geom(self.labeled_data.loc[self.labeled_data['cluster'].isin(clusters)])\
-            .plot(ax = ax, color = cluster_color, alpha = cluster_alpha)
+        places_to_geom(members).plot(ax = ax, color = cluster_color, alpha = cluster_alpha)
         
         #plot single point
-        places_to_geom(self.labeled_data[self.labeled_data.index == single])\
-            .plot(ax = ax, color = single_color, alpha = single_alpha)
+        places_to_geom(points).plot(ax = ax, color = single_color, alpha = single_alpha)
         
         if title:
             plt.title(title)
         plt.axis('off')
         
     def map_single(self, single, map_shape, color = 'blue',
-                   alpha = .5, fig = None, ax = None):
+                   alpha = .5, fig = None, ax = None, raster = False):
         """Plot a single data point on the map.
         
         args:
         single: row index of the point in data
         map_shape = shape which can be used as geopandas geometry, given in lat/long
+        raster = if True, draws the cached outline of map_shape and the point directly with matplotlib, without building GeoDataFrames
         
         Plots the image using geopandas.
         """
         if (not fig) or (not ax): #create fig,ax if not provided
             fig,ax = plt.subplots(figsize = (10,10))
+        
+        points = self._labeled_rows(np.flatnonzero(self.data.index == single))
+        if raster:
+            plot_boundary(map_shape, ax)
+            ax.scatter(points['longitude'], points['latitude'], color = color, alpha = alpha)
+            plt.axis('off')
+            return
             
         #Plot boundary
         boundary = gpd.GeoDataFrame(data = pd.DataFrame({'shape':['shape1']}), 
@@ -426,8 +996,7 @@ class AnomalyAnalyzer:
         boundary.plot(ax =ax, alpha = .5)
         
         #plot single point
-        places_to_geom(self.labeled_data[self.labeled_data.index == single])\
-            .plot(ax = ax, color = color, alpha = alpha)
+        places_to_geom(points).plot(ax = ax, color = color, alpha = alpha)
         plt.axis('off')
 
         
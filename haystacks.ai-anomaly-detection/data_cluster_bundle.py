@@ -1,5 +1,16 @@
 import pandas as pd
 import numpy as np
+import os
+import json
+
+def smallest_int_labels(labels):
+    """
+    Returns the labels in the smallest integer dtype holding all of them. Non-integer labels are returned unchanged.
+    """
+    labels = np.asarray(labels)
+    if labels.dtype.kind not in 'iu' or labels.size == 0:
+        return labels
+    return labels.astype(np.result_type(np.min_scalar_type(labels.min()), np.min_scalar_type(labels.max())))
 
 class DataClusterBundle:
     '''
@@ -12,8 +23,17 @@ class DataClusterBundle:
     for each data point
     labels is a numpy array of shape (n_samples, ) containing the cluster labels
     for each data point
+    compact: if True, pca_data and coords are stored as contiguous float32 arrays
+    and integer labels in the smallest integer dtype holding them, which roughly
+    halves the memory of the bundle. float32 keeps about 7 significant digits, so
+    coordinates are accurate to about a meter and pca values to a relative 1e-7.
     '''
-    def __init__(self, pca_data, coords, labels):
+    def __init__(self, pca_data, coords, labels, compact = False):
+        self.compact = compact
+        if compact:
+            pca_data = pd.DataFrame(np.ascontiguousarray(pca_data, dtype = np.float32), index = pca_data.index, columns = pca_data.columns)
+            coords = np.ascontiguousarray(coords, dtype = np.float32)
+            labels = smallest_int_labels(labels)
         self.data = pca_data
         self.coords = pd.DataFrame({'latitude' : coords[:,0], 'longitude' : coords[:,1]}, index = self.data.index)
         self.labels = labels
@@ -25,4 +45,65 @@ class DataClusterBundle:
         """
         Returns dataframe showing the number of datapoints in each cluster.
         """
-        return pd.Series(self.labels).value_counts().reset_index().rename({'index':'cluster_label', 0: 'n_members'}, axis = 1)
\ No newline at end of file
+        return pd.Series(self.labels).value_counts().reset_index().rename({'index':'cluster_label', 0: 'n_members'}, axis = 1)
+    
+    def save(self, path):
+        """
+        Saves the bundle to the directory at path, to be reopened with DataClusterBundle.open.
+        
+        The data, coords, and labels are written as row-aligned .npy files (data.npy of shape (n_samples, n_columns), coords.npy of shape (n_samples, 2), and labels.npy), together with the column labels (columns.npy) and the row index (index.npy) unless it is a RangeIndex, so both keep their dtype. A manifest.json records the index and compact flag.
+        """
+        os.makedirs(path, exist_ok = True)
+        np.save(os.path.join(path, 'data.npy'), np.ascontiguousarray(self.data.values))
+        np.save(os.path.join(path, 'coords.npy'), np.ascontiguousarray(self.coords[['latitude', 'longitude']].values))
+        labels = np.asarray(self.labels)
+        np.save(os.path.join(path, 'labels.npy'), labels, allow_pickle = labels.dtype == object)
+        
+        columns = self.data.columns
+        np.save(os.path.join(path, 'columns.npy'), columns.values, allow_pickle = columns.dtype == object)
+        index = self.data.index
+        if isinstance(index, pd.RangeIndex):
+            index_info = {'start': index.start, 'stop': index.stop, 'step': index.step}
+        else:
+            index_info = None
+            np.save(os.path.join(path, 'index.npy'), index.values, allow_pickle = index.dtype == object)
+        manifest = {'n_samples': int(self.data.shape[0]),
+                    'columns_name': columns.name,
+                    'range_index': index_info,
+                    'index_name': index.name,
+                    'compact': bool(getattr(self, 'compact', False))}
+        with open(os.path.join(path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, default = str)
+    
+    @classmethod
+    def open(cls, path, mmap_mode = 'r'):
+        """
+        Opens a bundle written by save. The data and coords DataFrames and the labels are backed directly by the memory-mapped .npy files, so opening takes the same time whatever the size of the bundle, and processes opening the same bundle share one copy of it in the page cache.
+        
+        args:
+            path: directory passed to save
+            mmap_mode: mode passed to np.load. 'r' memory-maps the files read-only, 'c' copy-on-write, and None reads them into memory.
+        """
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        data = np.load(os.path.join(path, 'data.npy'), mmap_mode = mmap_mode)
+        coords = np.load(os.path.join(path, 'coords.npy'), mmap_mode = mmap_mode)
+        labels_path = os.path.join(path, 'labels.npy')
+        try:
+            labels = np.load(labels_path, mmap_mode = mmap_mode)
+        except ValueError: #object labels are pickled and cannot be memory-mapped
+            labels = np.load(labels_path, allow_pickle = True)
+        
+        columns = pd.Index(np.load(os.path.join(path, 'columns.npy'), allow_pickle = True), name = manifest['columns_name'])
+        if manifest['range_index'] is not None:
+            index = pd.RangeIndex(**manifest['range_index'], name = manifest['index_name'])
+        else:
+            index = pd.Index(np.load(os.path.join(path, 'index.npy'), allow_pickle = True), name = manifest['index_name'])
+        
+        #Set the attributes directly, since __init__ would copy the coordinates into a new frame
+        bundle = cls.__new__(cls)
+        bundle.compact = manifest['compact']
+        bundle.data = pd.DataFrame(data, index = index, columns = columns, copy = False)
+        bundle.coords = pd.DataFrame(coords, index = index, columns = ['latitude', 'longitude'], copy = False)
+        bundle.labels = labels
+        return bundle
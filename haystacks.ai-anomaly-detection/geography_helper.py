@@ -6,7 +6,14 @@ tqdm.pandas(desc = 'progress')
 from shapely.geometry import Point
 from matplotlib import pyplot as plt
 from shapely.wkt import dumps, loads
+import shapely
+from shapely.strtree import STRtree
 from sklearn.metrics.pairwise import haversine_distances
+from sklearn.neighbors import BallTree
+from functools import lru_cache
+import os
+import json
+import hashlib
 
 #Converts df with latitude and longitude columns to GeoDataFrame. Needed for many geometric/geographic computations.
 
@@ -29,7 +36,7 @@ def places_to_geom(places, plot = False):
 
 def check_in_boundary(pointgdf, polygon):
     """
-    Checks if each point in a GeoDataFrame is contained in a given shapely polygon.
+    Checks if each point in a GeoDataFrame is contained in a given shapely polygon. Point geometries are tested all at once with points_in_boundary.
     
     arg: 
         pointgdf: a GeoDataFrame of points
@@ -37,39 +44,235 @@ def check_in_boundary(pointgdf, polygon):
     returns:
         Boolean pandas series. Each coordinate is the result of testing if the given point is in the polygon.
     """
+    geometry = np.asarray(pointgdf.geometry)
+    if len(geometry) and (shapely.get_type_id(geometry) == 0).all():
+        inside = points_in_boundary(shapely.get_x(geometry), shapely.get_y(geometry), polygon)
+    else:
+        exact = shapely.from_wkb(shapely.to_wkb(polygon)) #copy, so that preparing it leaves the caller's polygon alone
+        shapely.prepare(exact)
+        inside = shapely.contains(exact, geometry)
+    return pd.Series(inside, index = pointgdf.index, name = pointgdf.geometry.name, dtype = bool)
+
+#Cell classes of boundary_index
+OUTSIDE, INSIDE, EDGE = 0, 1, 2
+
+@lru_cache(maxsize = 8)
+def boundary_index(boundary, cells = 256, tolerance = None):
+    """
+    Precomputes what points_in_boundary needs to test many points against a shapely (multi)polygon. Cached, so it is only built once per boundary.
+    
+    The index consists of an inner and an outer simplified polygon, obtained by shrinking (growing) the boundary by 2 * tolerance and simplifying it with the given tolerance, so the inner one lies strictly inside the boundary and the outer one strictly contains it. A cells x cells grid over the bounds of the boundary classifies each cell as INSIDE (contained in the inner polygon), OUTSIDE (disjoint from the outer polygon), or EDGE.
+    
+    args:
+        boundary: shapely (multi)polygon
+        cells: number of grid cells along each axis
+        tolerance: simplification tolerance, by default 1/1000 of the larger side of the bounds
+    returns:
+        dictionary with the 'bounds' of the grid, the 'grid' of cell classes (rows along y), and the prepared 'inner', 'outer', and 'exact' polygons
+    """
+    x0, y0, x1, y1 = boundary.bounds
+    if tolerance is None:
+        tolerance = 1e-3 * max(x1 - x0, y1 - y0)
+    inner = boundary.buffer(-2 * tolerance).simplify(tolerance)
+    outer = boundary.buffer(2 * tolerance).simplify(tolerance)
+    exact = shapely.from_wkb(shapely.to_wkb(boundary)) #copy, so that preparing it leaves the caller's geometry alone
+    for polygon in (inner, outer, exact):
+        shapely.prepare(polygon)
     
-    return pointgdf.geometry.progress_apply(lambda x: polygon.contains(x))
+    xs = np.linspace(x0, x1, cells + 1)
+    ys = np.linspace(y0, y1, cells + 1)
+    boxes = shapely.box(xs[None, :-1], ys[:-1, None], xs[None, 1:], ys[1:, None])
+    grid = np.full((cells, cells), EDGE, dtype = np.int8)
+    grid[shapely.contains(inner, boxes)] = INSIDE
+    grid[~shapely.intersects(outer, boxes)] = OUTSIDE
+    return {'bounds': (x0, y0, x1, y1), 'grid': grid, 'inner': inner, 'outer': outer, 'exact': exact}
 
+def points_in_boundary(longitude, latitude, boundary, cells = 256):
+    """
+    Tests if each point is contained in a shapely (multi)polygon given in lat/long, with the same result as boundary.contains(Point(longitude, latitude)) (so points on the boundary and points with missing coordinates are not contained).
+    
+    Points are classified by the cell of the boundary_index grid they fall in. Only the points in EDGE cells are tested against the simplified polygons, and only those between the inner and outer polygon get the exact test against the prepared boundary.
+    
+    args:
+        longitude, latitude: arrays of coordinates
+        boundary: shapely (multi)polygon given in lat/long
+        cells: number of grid cells along each axis, passed to boundary_index
+    returns:
+        Boolean numpy array
+    """
+    x = np.asarray(longitude, dtype = float)
+    y = np.asarray(latitude, dtype = float)
+    index = boundary_index(boundary, cells = cells)
+    x0, y0, x1, y1 = index['bounds']
+    grid = index['grid']
+    
+    inside = np.zeros(len(x), dtype = bool)
+    in_bounds = np.flatnonzero((x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)) #False for nan coordinates
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        col = np.clip(((x[in_bounds] - x0) / (x1 - x0) * grid.shape[1]).astype(int), 0, grid.shape[1] - 1)
+        row = np.clip(((y[in_bounds] - y0) / (y1 - y0) * grid.shape[0]).astype(int), 0, grid.shape[0] - 1)
+    cell = grid[row, col]
+    inside[in_bounds[cell == INSIDE]] = True
+    
+    edge = in_bounds[cell == EDGE]
+    points = shapely.points(x[edge], y[edge])
+    in_inner = shapely.contains(index['inner'], points)
+    inside[edge[in_inner]] = True
+    unsure = ~in_inner & shapely.covers(index['outer'], points)
+    inside[edge[unsure]] = shapely.contains(index['exact'], points[unsure])
+    return inside
 
-def tract_containing(point, censusgdf, id_col = 'GEOID'):
+def tract_containing(point, censusgdf, id_col = 'GEOID', no_tract = None):
     """
     Finds the GEOID of the census tract containing the given point. 
     
     args:
         point: a shapely point given in longitude and latitude.
         censusdf: a GeoDataFrame of census tract shapes with a column named 'GEOID'
+        no_tract: value returned if no tract contains the point
     returns:
         GEOD of census tract the point belongs to
     """
-    censusgdf = censusgdf.reset_index()
-    tracts = censusgdf.geometry
-    results = np.ones(len(censusgdf))
-    for idx, tract in enumerate(tracts):
-        results[idx] = tract.contains(point)
+    inside = censusgdf.geometry.contains(point).values
+    if not inside.any():
+        return no_tract
+    return censusgdf[id_col].values[inside.argmax()]
+
+def tracts_containing(points, censusgdf, id_col = 'GEOID', no_tract = None):
+    """
+    Finds the census tract containing each of the given points at once. An STR-tree over the tract polygons gives the tracts whose bounding box contains each point, and only those candidates are tested exactly, against prepared tract geometries, in one vectorized call.
+    
+    args:
+        points: array or GeoSeries of shapely points given in longitude and latitude
+        censusgdf: GeoDataFrame of census tracts
+        id_col: column of censusgdf identifying the tracts
+        no_tract: label of the points which are in no tract
+    returns:
+        array with the id_col value of the tract containing each point, or no_tract. A point on the boundary of several tracts gets the first of them, as in tract_containing.
+    """
+    points = np.asarray(points)
+    tracts = shapely.from_wkb(shapely.to_wkb(np.asarray(censusgdf.geometry))) #copy, so that preparing it leaves censusgdf alone
+    tree = STRtree(tracts)
+    point_idx, tract_idx = tree.query(points)
+    shapely.prepare(tracts)
+    inside = shapely.contains(tracts[tract_idx], points[point_idx])
+    point_idx, tract_idx = point_idx[inside], tract_idx[inside]
+    
+    #First containing tract of every point
+    order = np.lexsort((tract_idx, point_idx))
+    point_idx, tract_idx = point_idx[order], tract_idx[order]
+    first = np.concatenate([[True], point_idx[1:] != point_idx[:-1]]) if len(point_idx) else np.array([], dtype = bool)
+    result = np.full(len(points), no_tract, dtype = object)
+    result[point_idx[first]] = censusgdf[id_col].values[tract_idx[first]]
+    return result
+
+def tract_file_hash(censusgdf, id_col = 'GEOID'):
+    """
+    Returns a sha256 hex digest of the tract geometries and ids, identifying a version of the tract file.
+    """
+    h = hashlib.sha256()
+    h.update(repr(id_col).encode())
+    h.update(np.asarray(censusgdf[id_col].astype(str)).astype('U').tobytes())
+    for wkb in shapely.to_wkb(np.asarray(censusgdf.geometry)):
+        h.update(wkb)
+    return h.hexdigest()
+
+def _quantized_keys(latitude, longitude, decimals):
+    #One int64 key per coordinate pair: lat and long rounded to the given decimals, offset to be nonnegative, in the high and low 32 bits.
+    #Fits for up to 6 decimals, since |lat| * 10**6 < 2**30 and |long| * 10**6 < 2**31
+    scale = 10 ** decimals
+    lat = np.round(np.asarray(latitude, dtype = float) * scale).astype(np.int64)
+    long = np.round(np.asarray(longitude, dtype = float) * scale).astype(np.int64)
+    return ((lat + 2**30) << 32) | (long + 2**31)
 
-    return censusgdf.loc[results.argmax(),id_col]
+def _keys_to_points(keys, decimals):
+    #Points at the quantized coordinates of the keys
+    scale = 10 ** decimals
+    lat = ((keys >> 32) - 2**30) / scale
+    long = ((keys & (2**32 - 1)) - 2**31) / scale
+    return shapely.points(long, lat)
 
-def add_census_tracts(places, censusgdf, id_col = 'GEOID'):
+def cached_tracts_containing(latitude, longitude, censusgdf, cache_dir, id_col = 'GEOID', no_tract = None, decimals = 6):
+    """
+    Same as tracts_containing for arrays of latitudes and longitudes, but remembers the tract of every coordinate in a cache on disk, so that repeated calls only run the point in polygon tests for coordinates not seen before.
+    
+    Coordinates are rounded to the given decimals (6 decimals is about 10cm), and the tract of a rounded coordinate is that of the rounded point. The cache is stored in cache_dir as a single cache.npz of sorted int64 keys of the rounded coordinates and the tract ids, and looked up for all points at once with a binary search. It belongs to the tract file hash (see tract_file_hash), id_col, and decimals it was built with: if any of them changes, the stale entries are dropped and the cache is rebuilt.
+    
+    args:
+        latitude, longitude: arrays of coordinates
+        censusgdf: GeoDataFrame of census tracts
+        cache_dir: directory of the cache, created if needed
+        id_col: column of censusgdf identifying the tracts
+        no_tract: label of the points which are in no tract
+        decimals: number of decimals the coordinates are rounded to, at most 6
+    returns:
+        array with the id_col value of the tract containing each point, or no_tract
     """
-    Converts dataframe with 'latitude' and 'longitude' columns to a GeoDataFrame and adds census tract data. Essentially just 'places_to_geom' composed with coordinatewise application of 'tract_containing', but adds a tqdm processing bar since this can take a few minutes on a large dataframe.
+    if decimals > 6:
+        raise ValueError('decimals must be at most 6')
+    os.makedirs(cache_dir, exist_ok = True)
+    manifest_path = os.path.join(cache_dir, 'manifest.json')
+    cache_path = os.path.join(cache_dir, 'cache.npz')
+    manifest = {'tract_hash': tract_file_hash(censusgdf, id_col), 'id_col': id_col, 'decimals': decimals}
+    
+    cached_keys = np.array([], dtype = np.int64)
+    cached_tracts = np.array([], dtype = 'U1')
+    if os.path.exists(manifest_path) and os.path.exists(cache_path):
+        with open(manifest_path) as f:
+            manifest_matches = json.load(f) == manifest
+        if manifest_matches:
+            with np.load(cache_path) as cache:
+                #The manifest is also stored in the npz, so that a write interrupted before the manifest was replaced is not read with the old one
+                if json.loads(str(cache['manifest'])) == manifest and len(cache['keys']) == len(cache['tracts']):
+                    cached_keys = cache['keys']
+                    cached_tracts = cache['tracts']
+    
+    keys = _quantized_keys(latitude, longitude, decimals)
+    position = np.minimum(np.searchsorted(cached_keys, keys), max(len(cached_keys) - 1, 0))
+    hit = cached_keys[position] == keys if len(cached_keys) else np.zeros(len(keys), dtype = bool)
+    
+    new_keys = np.unique(keys[~hit])
+    if len(new_keys):
+        #Tracts of the coordinates not in the cache, with '' marking points in no tract
+        new_tracts = tracts_containing(_keys_to_points(new_keys, decimals), censusgdf, id_col = id_col, no_tract = '')
+        new_tracts = new_tracts.astype(str)
+        all_keys = np.concatenate([cached_keys, new_keys])
+        all_tracts = np.concatenate([cached_tracts.astype(str), new_tracts])
+        order = np.argsort(all_keys, kind = 'stable')
+        cached_keys, cached_tracts = all_keys[order], all_tracts[order]
+        
+        #Write next to the cache and then replace it in one step, with the manifest last, so that an interrupted write never leaves a corrupt cache
+        with open(cache_path + '.tmp', 'wb') as f:
+            np.savez(f, keys = cached_keys, tracts = cached_tracts, manifest = json.dumps(manifest))
+        os.replace(cache_path + '.tmp', cache_path)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        position = np.searchsorted(cached_keys, keys)
+    
+    #The cache stores the ids as strings: map them back to the values of id_col, so that the result matches tracts_containing
+    ids = {str(x): x for x in censusgdf[id_col].tolist()}
+    ids[''] = no_tract
+    unique_tracts, inverse = np.unique(cached_tracts[position], return_inverse = True)
+    return np.array([ids[x] for x in unique_tracts] + [None], dtype = object)[:-1][inverse]
+
+def add_census_tracts(places, censusgdf, id_col = 'GEOID', no_tract = None, cache_dir = None):
+    """
+    Converts dataframe with 'latitude' and 'longitude' columns to a GeoDataFrame and adds census tract data. Essentially 'places_to_geom' composed with 'tract_containing', with all points assigned at once by tracts_containing.
     
     args: 
         listings: DataFrame containing 'latitude' and 'longitude' columns
         censusgdf: GeoDataFrame of census tracts
+        no_tract: value of 'tract_containing' for listings which are in no tract
+        cache_dir: optional directory of a coordinate to tract cache (see cached_tracts_containing), so that repeated calls only locate new coordinates
     returns: GeoDataFrame of listings, together with point geometry for each listing, and a column showing which census tract each listing belongs to. Useful for merging census track-tagged data.
     """
     places_gdf = places_to_geom(places)
-    places_gdf['tract_containing'] = places_gdf['geometry'].progress_apply(lambda x: tract_containing(x,censusgdf, id_col = id_col))
+    if cache_dir is None:
+        places_gdf['tract_containing'] = tracts_containing(places_gdf.geometry.values, censusgdf, id_col = id_col, no_tract = no_tract)
+    else:
+        places_gdf['tract_containing'] = cached_tracts_containing(places['latitude'].values, places['longitude'].values, censusgdf,
+                                                                  cache_dir, id_col = id_col, no_tract = no_tract)
     return places_gdf
     
 #GA shapely object given in lat/long needed for mapping.
@@ -98,6 +301,101 @@ def import_GA_boundary_file(filename):
     return GAboundary
 
 
+#Rasterized mapping. Bins lat/long straight into a grid, so the time to draw a map does not depend on the number of points.
+
+@lru_cache(maxsize = 8)
+def boundary_outline(boundary):
+    """
+    Returns a list of (longitude, latitude) arrays, one for each exterior ring of a shapely (multi)polygon given in lat/long. Cached, so the boundary is only unpacked once.
+    """
+    polygons = boundary.geoms if hasattr(boundary, 'geoms') else [boundary]
+    return [np.asarray(polygon.exterior.coords.xy) for polygon in polygons]
+
+def plot_boundary(boundary, ax, alpha = .5, **kwargs):
+    """
+    Fills the shape of a shapely (multi)polygon given in lat/long on the given axis, without building a GeoDataFrame.
+    """
+    for x, y in boundary_outline(boundary):
+        ax.fill(x, y, alpha = alpha, **kwargs)
+
+def raster_grid(latitude, longitude, values = None, how = 'count', bins = 500, extent = None):
+    """
+    Bins points into a grid of cells over lat/long.
+    
+    args:
+        latitude, longitude: arrays of coordinates
+        values: array of values for each point. Needed for how = 'mean' (e.g. prices) and how = 'label' (e.g. cluster labels).
+        how: 'count' (number of points in each cell), 'mean' (average value in each cell), or 'label' (most common value in each cell)
+        bins: number of cells along each axis, or a (n_lat, n_long) pair
+        extent: optional (long_min, long_max, lat_min, lat_max). Defaults to the range of the points.
+    returns:
+        (grid, extent). grid has shape (n_lat, n_long) with row 0 at the lowest latitude, and NaN in cells without points. extent can be passed to imshow.
+    """
+    latitude = np.asarray(latitude, dtype = float)
+    longitude = np.asarray(longitude, dtype = float)
+    n_lat, n_long = (bins, bins) if np.isscalar(bins) else bins
+    if extent is None:
+        extent = (longitude.min(), longitude.max(), latitude.min(), latitude.max())
+    long_min, long_max, lat_min, lat_max = extent
+    
+    #Cell of each point, dropping points outside the extent
+    row = np.floor((latitude - lat_min) / max(lat_max - lat_min, 1e-12) * n_lat).astype(int)
+    col = np.floor((longitude - long_min) / max(long_max - long_min, 1e-12) * n_long).astype(int)
+    row = np.minimum(row, n_lat - 1) #points on the upper edges belong to the last cells
+    col = np.minimum(col, n_long - 1)
+    inside = (row >= 0) & (row < n_lat) & (col >= 0) & (col < n_long)
+    cell = row[inside] * n_long + col[inside]
+    counts = np.bincount(cell, minlength = n_lat * n_long).astype(float)
+    
+    if how == 'count':
+        grid = counts
+    elif how == 'mean':
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            grid = np.bincount(cell, weights = np.asarray(values, dtype = float)[inside], minlength = n_lat * n_long) / counts
+    elif how == 'label':
+        #Most common label in each cell: count (cell, label) pairs and keep the largest count per cell
+        labels, codes = np.unique(np.asarray(values)[inside], return_inverse = True)
+        pairs, pair_counts = np.unique(cell * len(labels) + codes, return_counts = True)
+        pair_cell, pair_code = np.divmod(pairs, len(labels))
+        order = np.lexsort((-pair_counts, pair_cell))
+        first = np.concatenate([[True], pair_cell[order][1:] != pair_cell[order][:-1]]) if len(order) else np.array([], dtype = bool)
+        grid = np.full(n_lat * n_long, np.nan)
+        grid[pair_cell[order][first]] = labels[pair_code[order][first]]
+    else:
+        raise ValueError("how must be 'count', 'mean', or 'label'")
+    
+    grid = np.where(counts > 0, grid, np.nan)
+    return grid.reshape(n_lat, n_long), extent
+
+def plot_raster_map(latitude, longitude, values = None, how = 'count', boundary = None, bins = 500, extent = None, ax = None, cmap = None, **kwargs):
+    """
+    Draws points on a map as a raster (see raster_grid), with the shape of the boundary underneath if one is given. Much faster than plotting a GeoDataFrame of points when there are many of them.
+    
+    args:
+        latitude, longitude, values, how, bins: passed to raster_grid
+        boundary: optional shapely (multi)polygon in lat/long, e.g. from import_GA_boundary_file
+        extent: optional (long_min, long_max, lat_min, lat_max). Defaults to the bounds of the boundary if given, and of the points otherwise.
+        ax: matplotlib axis to draw on. A new figure is created if not given.
+        cmap: matplotlib colormap. Defaults to 'viridis', or 'tab20' for labels.
+        kwargs: passed to imshow
+    returns:
+        the AxesImage of the raster
+    """
+    if ax is None:
+        fig, ax = plt.subplots(figsize = (10,10))
+    if extent is None and boundary is not None:
+        long_min, lat_min, long_max, lat_max = boundary.bounds
+        extent = (long_min, long_max, lat_min, lat_max)
+    if boundary is not None:
+        plot_boundary(boundary, ax)
+    grid, extent = raster_grid(latitude, longitude, values = values, how = how, bins = bins, extent = extent)
+    if cmap is None:
+        cmap = 'tab20' if how == 'label' else 'viridis'
+    image = ax.imshow(grid, extent = extent, origin = 'lower', cmap = cmap, interpolation = 'nearest', **kwargs)
+    ax.set_xlim(extent[0], extent[1])
+    ax.set_ylim(extent[2], extent[3])
+    return image
+
 #Distance related functions
 def haversine_distance(x, y):
     """
@@ -122,24 +420,49 @@ def distances_from_dfs(df1, df2):
     """
     return haversine_distances(lat_long_rad(df1), lat_long_rad(df2)) * 6371000/1000
 
-def get_n_closest(df1, df2, n, limit = None):
+def nearest_points(df1, df2, n, limit = None, chunksize = 10000):
+    """
+    Finds the n closest points in df2 to each point in df1 with a haversine BallTree over df2, without computing the distances between all pairs of points. df1 is queried in chunks of chunksize rows, so memory stays bounded by the chunk size, n, and the tree.
+    
+    args:
+        df1 and df2: dataframes with 'latitude' and 'longitude' columns
+        n: the number of nearest points in df2 to find
+        limit: an optional limit in km. Neighbours farther than the limit are dropped
+        chunksize: number of rows of df1 queried at a time
+    returns:
+        distances: (len(df1), min(n, len(df2))) array of distances in km, sorted in increasing order in each row, and inf for neighbours beyond the limit
+        indices: array of the same shape with the row indices of df2 of the neighbours, and -1 for neighbours beyond the limit
+    """
+    tree = BallTree(lat_long_rad(df2), metric = 'haversine')
+    points = lat_long_rad(df1)
+    k = min(n, len(df2))
+    distances = np.empty((len(points), k))
+    indices = np.empty((len(points), k), dtype = np.int64)
+    for start in range(0, len(points), chunksize):
+        dist, ind = tree.query(points[start:start + chunksize], k = k)
+        distances[start:start + chunksize] = dist * 6371000/1000
+        indices[start:start + chunksize] = ind
+    if limit:
+        beyond = distances > limit
+        distances[beyond] = np.inf
+        indices[beyond] = -1
+    return distances, indices
+
+def get_n_closest(df1, df2, n, limit = None, chunksize = 10000):
     """
-    Gets the row indices of the n closest points in df2 to each point in df1, within a limit, if desired.
+    Gets the row indices of the n closest points in df2 to each point in df1, within a limit, if desired. The neighbours are found with nearest_points, in chunks of chunksize rows of df1.
     args: 
         df1 and df2: dataframes with 'latitude' and 'longitude' columns
         n: the number of nearest points in df2 to find
         limit: an optional limit in km
+        chunksize: number of rows of df1 queried at a time
     return:
         A list the length of df1. The ith element in is a list of row indices of df2, identifying the n closest points of df2 to this element, within the limit distance. 
     """
-    distances = distances_from_dfs(df1,df2)
-    n_closest = distances.argsort()[:,:n]
+    _, n_closest = nearest_points(df1, df2, n, limit = limit, chunksize = chunksize)
     
     if limit:
-        closest =[]
-        for k in range(n_closest.shape[0]):
-            closest.append([x for x in n_closest[k] if distances[k,x] <= limit])
-        return closest
+        return [list(row[row >= 0]) for row in n_closest]
     else:
         return n_closest
 
@@ -176,12 +499,12 @@ def apply_local_aggfunc(df1, df2, aggfunc, n, limit = None, name = 'agg_value'):
     neighborhood = get_n_closest(df1, df2, n, limit = limit)
     return pd.Series([get_aggregate(df2, x, aggfunc) for x in neighborhood], name = name)
 
-def min_distance(df1, df2, name = 'closest_dist'):
+def min_distance(df1, df2, name = 'closest_dist', chunksize = 10000):
     """
-    df1 and df2 must be dataframes containing columns 'latitude' and 'longitude'. Uses haversine distance to find the distance from each point in df1 to the closest point in df2.
+    df1 and df2 must be dataframes containing columns 'latitude' and 'longitude'. Uses haversine distance to find the distance from each point in df1 to the closest point in df2, with nearest_points.
     """
-    distances = distances_from_dfs(df1, df2)
-    return pd.Series(distances.min(axis = 1), name = name)
+    distances, _ = nearest_points(df1, df2, 1, chunksize = chunksize)
+    return pd.Series(distances[:, 0], name = name)
 
 def filter_by_boundary(df, boundary):
     """
@@ -192,9 +515,119 @@ def filter_by_boundary(df, boundary):
     returns:
         dataframe filtered to those inside the boundary
     """
-    gdf = places_to_geom(df)
-    GA_filter = check_in_boundary(gdf,boundary)
+    GA_filter = points_in_boundary(df['longitude'].values, df['latitude'].values, boundary)
     print(f'Dropped {(~GA_filter).sum()} rows which were outside the boundary')
     print(f'{GA_filter.sum()} rows are remaining')
-    return pd.DataFrame(gdf[GA_filter]).drop('geometry', axis = 1)
-    
\ No newline at end of file
+    return df[GA_filter].copy()
+    
+def _read_chunks(path, chunksize, **read_kwargs):
+    #DataFrames of at most chunksize rows of a CSV or parquet file. An empty file gives one empty DataFrame with its columns
+    if path.endswith('.parquet') or path.endswith('.pq'):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path)
+        empty = True
+        for batch in parquet_file.iter_batches(batch_size = chunksize, **read_kwargs):
+            empty = False
+            yield batch.to_pandas()
+        if empty:
+            table = parquet_file.schema_arrow.empty_table()
+            columns = read_kwargs.get('columns')
+            yield (table.select(columns) if columns is not None else table).to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize = chunksize, **read_kwargs)
+
+def _chunk_schema(path, chunksize, **read_kwargs):
+    #Arrow schema for all the chunks of a file, from one pass over it. Chunks are typed separately (e.g. a column without values
+    #in a chunk of a CSV is read as float), so columns without values in a chunk are left to the other chunks, and numeric types are promoted
+    import pyarrow as pa
+    schemas = []
+    first = None
+    for chunk in _read_chunks(path, chunksize, **read_kwargs):
+        table = pa.Table.from_pandas(chunk, preserve_index = False)
+        first = first or table.schema
+        schemas.append(pa.schema([pa.field(field.name, pa.null()) if len(table) and table.column(k).null_count == len(table) else field
+                                  for k, field in enumerate(table.schema)]))
+    try:
+        schema = pa.unify_schemas(schemas, promote_options = 'permissive')
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+        raise ValueError('Columns of {} have incompatible types in different chunks. Pass dtype (for CSV files) or schema.'.format(path)) from e
+    #Columns without any value keep the type they were read with
+    return pa.schema([first.field(field.name) if pa.types.is_null(field.type) else field for field in schema], metadata = schema.metadata)
+
+def _parquet_schema(path, columns = None):
+    #Arrow schema of the chunks of a parquet file, read from its metadata. The pandas index columns are left out, as the chunks are
+    #written without their index, and so is the pandas metadata which describes them
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pq.ParquetFile(path).schema_arrow
+    pandas_metadata = json.loads((schema.metadata or {}).get(b'pandas', b'{}'))
+    index_columns = [col for col in pandas_metadata.get('index_columns', []) if isinstance(col, str)]
+    names = columns if columns is not None else [name for name in schema.names if name not in index_columns]
+    return pa.schema([schema.field(name) for name in names])
+
+def _table_with_schema(chunk, schema):
+    #Arrow table of a chunk with the given schema. Columns without values are replaced by nulls of the schema's type,
+    #since they may have been read with a type which cannot be cast to it
+    import pyarrow as pa
+    table = pa.Table.from_pandas(chunk, preserve_index = False)
+    columns = [pa.nulls(len(table), field.type) if table.column(field.name).null_count == len(table) else table.column(field.name).cast(field.type)
+               for field in schema]
+    return pa.Table.from_arrays(columns, schema = schema)
+
+def iter_filter_by_boundary(path, boundary, chunksize = 100000, **read_kwargs):
+    """
+    Generator version of filter_by_boundary for files too large to load at once. Reads the CSV or parquet file at path in chunks, and yields the rows of each chunk which are contained in the boundary. Points are tested with points_in_boundary straight from the 'latitude' and 'longitude' columns, without building GeoDataFrames, so memory depends on the chunk size only.
+    
+    args:
+        path: path to a CSV file, or a parquet file (ending in .parquet or .pq, read with pyarrow) with 'latitude' and 'longitude' columns
+        boundary: shapely polygon given in lat/long
+        chunksize: number of rows read at a time
+        read_kwargs: passed to pd.read_csv, or to ParquetFile.iter_batches (e.g. columns)
+    yields:
+        DataFrames of the rows inside the boundary, chunk by chunk
+    """
+    for chunk in _read_chunks(path, chunksize, **read_kwargs):
+        yield chunk[points_in_boundary(chunk['longitude'].values, chunk['latitude'].values, boundary)]
+
+def filter_file_by_boundary(path, output_path, boundary, chunksize = 100000, schema = None, **read_kwargs):
+    """
+    Filters the CSV or parquet file at path to the rows contained in the boundary with iter_filter_by_boundary, and writes them to output_path chunk by chunk, as parquet if output_path ends in .parquet or .pq and as CSV otherwise. The output file is always written, with just the columns if no row is kept.
+    
+    Parquet output needs one schema for all the chunks. Unless it is given, it is read from the metadata of a parquet input, and for a CSV input it is found by a first pass over the file which unifies the types of the chunks: a column without values in some chunks takes its type from the others, and integers are promoted to floats. Columns with incompatible types in different chunks (e.g. numbers in some and text in others) raise a ValueError, and need a dtype passed to pd.read_csv or an explicit schema.
+    
+    args:
+        path: path to the input file, as in iter_filter_by_boundary
+        output_path: path to the filtered file
+        boundary: shapely polygon given in lat/long
+        chunksize: number of rows read at a time
+        schema: optional pyarrow schema of the parquet output
+        read_kwargs: passed to the reader, as in iter_filter_by_boundary (e.g. dtype for pd.read_csv)
+    returns:
+        number of rows written
+    """
+    to_parquet = output_path.endswith('.parquet') or output_path.endswith('.pq')
+    if to_parquet:
+        import pyarrow.parquet as pq
+        if schema is None and (path.endswith('.parquet') or path.endswith('.pq')):
+            schema = _parquet_schema(path, read_kwargs.get('columns'))
+        elif schema is None:
+            schema = _chunk_schema(path, chunksize, **read_kwargs)
+    writer = pq.ParquetWriter(output_path, schema) if to_parquet else None
+    first = True
+    n_read, n_kept = 0, 0
+    try:
+        for chunk in _read_chunks(path, chunksize, **read_kwargs):
+            n_read += len(chunk)
+            chunk = chunk[points_in_boundary(chunk['longitude'].values, chunk['latitude'].values, boundary)]
+            n_kept += len(chunk)
+            if to_parquet:
+                writer.write_table(_table_with_schema(chunk, schema))
+            else:
+                chunk.to_csv(output_path, mode = 'w' if first else 'a', header = first, index = False)
+            first = False
+    finally:
+        if writer is not None:
+            writer.close()
+    print(f'Dropped {n_read - n_kept} rows which were outside the boundary')
+    print(f'{n_kept} rows are remaining')
+    return n_kept
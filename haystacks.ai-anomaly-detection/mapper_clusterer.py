@@ -3,11 +3,18 @@ from sklearn.cluster import DBSCAN
 import pandas as pd
 import numpy as np
 import tqdm
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, identity
 from matplotlib import pyplot as plt
-from geography_helper import import_GA_boundary_file, places_to_geom, distances_from_dfs, haversine_distance
+from geography_helper import import_GA_boundary_file, places_to_geom, distances_from_dfs, haversine_distance, plot_raster_map
 from sklearn.neighbors import NearestNeighbors
+from sklearn.metrics import pairwise_distances
 from scipy.sparse import csgraph
+from scipy.cluster.hierarchy import linkage as linkage_tree, fcluster
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import os
+import json
+import hashlib
 
 def get_clusters_containing(ind, clustergraph):
     clusters = dict(clustergraph['nodes'])
@@ -68,6 +75,303 @@ def graph_to_adjacency(data, clustergraph):
     vals = np.ones(len(col))
     return csr_matrix((vals, (row,col)), dtype = np.int8)
 
+def graph_to_incidence(n_samples, clustergraph):
+    """
+    Takes in a mapper graph whose clusters contain indices of n_samples datapoints. Returns a sparse incidence matrix of size (n_samples, n_nodes) whose (i, k) entry is 1 if datapoint i is contained in the kth node, together with the list of node names giving the column order.
+    args:
+        n_samples: number of datapoints the graph was built on
+        clustergraph: a mapper graph such that each node contains indices of the datapoints
+    returns: sparse incidence matrix, list of node names
+    """
+    nodes = list(clustergraph['nodes'].keys())
+    members = [clustergraph['nodes'][node] for node in nodes]
+    sizes = np.array([len(x) for x in members], dtype = np.int64)
+    
+    row = np.concatenate(members).astype(np.int64) if len(members) else np.array([], dtype = np.int64)
+    col = np.repeat(np.arange(len(nodes)), sizes)
+    vals = np.ones(len(row), dtype = np.int8)
+    return csr_matrix((vals, (row, col)), shape = (n_samples, len(nodes)), dtype = np.int8), nodes
+
+def graph_to_adjacency_sparse(data, clustergraph):
+    """
+    Same as graph_to_adjacency, but builds the point-to-node incidence matrix M once and computes the adjacency on the data as M (I + L) M^T, where L is the node link matrix. Avoids scanning every node for every datapoint, so it scales to large mapper graphs.
+    
+    The result has shape (n_samples, n_samples) even when the last datapoints are not contained in any node, so that every row of the data gets a component label.
+    args:
+        data: dataframe
+        clustergraph: a mapper graph such that each node contains indices of the rows of data
+    returns: sparse adjacency matrix of graph on the data
+    """
+    samples = data.shape[0]
+    M, nodes = graph_to_incidence(samples, clustergraph)
+    
+    #Node-level adjacency: each node is connected to itself and to the nodes it branches to
+    node_idx = {node: k for k, node in enumerate(nodes)}
+    link_row = []
+    link_col = []
+    for node, branches in dict(clustergraph['links']).items():
+        for branch in branches:
+            link_row.append(node_idx[node])
+            link_col.append(node_idx[branch])
+    L = csr_matrix((np.ones(len(link_row), dtype = np.int8), (link_row, link_col)), shape = (len(nodes), len(nodes)))
+    L = (L + identity(len(nodes), dtype = np.int8, format = 'csr')).astype(bool).astype(np.int8)
+    
+    #Entry (i,j) counts the ways datapoint j is reachable from i, so binarize.
+    #The product is taken in int32 so that large counts cannot wrap around to zero.
+    M = M.astype(np.int32)
+    A = (M @ L.astype(np.int32) @ M.T).tocsr()
+    A.sort_indices()
+    return csr_matrix((np.ones(len(A.data), dtype = np.int8), A.indices, A.indptr), shape = A.shape)
+
+class DisjointSet:
+    """
+    Union-find structure over the integers 0, ..., n-1, with path halving and union by size. Used to merge the nodes of a mapper graph into clusters on the data without building the (n_samples, n_samples) adjacency matrix.
+    """
+    def __init__(self, n):
+        self.parent = np.arange(n)
+        self.size = np.ones(n, dtype = np.int64)
+        
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    def union(self, i, j):
+        root_i = self.find(i)
+        root_j = self.find(j)
+        if root_i == root_j:
+            return root_i
+        if self.size[root_i] < self.size[root_j]:
+            root_i, root_j = root_j, root_i
+        self.parent[root_j] = root_i
+        self.size[root_i] += self.size[root_j]
+        return root_i
+    
+    def roots(self):
+        """
+        Returns a numpy array with the root of every element.
+        """
+        return np.array([self.find(i) for i in range(len(self.parent))])
+
+def graph_to_components(n_samples, clustergraph):
+    """
+    Computes the connected components of the graph on the data described in graph_to_adjacency directly from the nodes and links of the mapper graph, using a disjoint-set structure over the data indices. Memory is O(n_samples + total node membership).
+    
+    Labels are numbered in order of the smallest data index in each component, which matches csgraph.connected_components applied to the adjacency matrix. Datapoints contained in no node are their own component.
+    args:
+        n_samples: number of datapoints the graph was built on
+        clustergraph: a mapper graph such that each node contains indices of the datapoints
+    returns: (number of components, numpy array of component labels of size (n_samples,))
+    """
+    ds = DisjointSet(n_samples)
+    nodes = clustergraph['nodes']
+    
+    #Every datapoint in a node is joined to the first member of that node
+    for members in nodes.values():
+        if len(members) == 0:
+            continue
+        first = members[0]
+        for ind in members[1:]:
+            ds.union(first, ind)
+            
+    #Linked nodes are joined through their first members
+    for node, branches in dict(clustergraph['links']).items():
+        if len(nodes[node]) == 0:
+            continue
+        for branch in branches:
+            if len(nodes[branch]):
+                ds.union(nodes[node][0], nodes[branch][0])
+    
+    #Relabel roots in order of first appearance
+    roots = ds.roots()
+    _, first_idx, inverse = np.unique(roots, return_index = True, return_inverse = True)
+    rank = np.empty(len(first_idx), dtype = np.int32)
+    rank[np.argsort(first_idx)] = np.arange(len(first_idx), dtype = np.int32)
+    return len(first_idx), rank[inverse]
+
+class QuadtreeCover:
+    """
+    Density-adaptive cover of the plane which can be used in place of a keplermapper Cover. Starting from the bounding rectangle of the coordinates, rectangles are recursively split into four quadrants until each cube (the rectangle enlarged by the overlap) contains at most max_points points. Dense regions are covered by many small cubes and sparse regions by a few large ones, so the cost of clustering each cube is bounded.
+    
+    Like km.Cover, fit and transform expect an index column followed by the coordinates, and adjacent cubes overlap by perc_overlap of their width along each dimension.
+    
+    attributes:
+        max_points: target maximum number of points in a cube
+        perc_overlap: overlap between adjacent cubes, between 0 and 1
+        max_depth: maximum number of splits, which stops recursion on stacks of identical coordinates
+        n_cubes: number of cubes after fitting
+        lower_, upper_: arrays of shape (n_cubes, 2) of the lower and upper bounds of each cube
+        centers_: list of the centers of the cubes
+    """
+    def __init__(self, max_points = 500, perc_overlap = 0.3, max_depth = 12, verbose = 0):
+        if not 0 <= perc_overlap < 1:
+            raise ValueError('perc_overlap must be in [0, 1)')
+        self.max_points = max_points
+        self.perc_overlap = perc_overlap
+        self.max_depth = max_depth
+        self.verbose = verbose
+        self.n_cubes = None
+        self.lower_ = None
+        self.upper_ = None
+        self.centers_ = None
+        
+    def __repr__(self):
+        return 'QuadtreeCover(max_points=%s, perc_overlap=%s, max_depth=%s)' % (self.max_points, self.perc_overlap, self.max_depth)
+    
+    def _expand(self, lower, upper):
+        #Enlarge a rectangle so that neighbouring cubes overlap by perc_overlap of their width
+        center = (lower + upper) / 2
+        radius = (upper - lower) / (2 * (1 - self.perc_overlap))
+        return center - radius, center + radius
+    
+    def fit(self, data):
+        """
+        Builds the quadtree on the data, whose first column must be an index column. Returns the list of cube centers.
+        """
+        points = np.asarray(data)[:, 1:].astype(float)
+        lowers = []
+        uppers = []
+        
+        #Depth-first over rectangles, keeping the indices of the points in each enlarged cube
+        stack = [(points.min(axis = 0), points.max(axis = 0), np.arange(points.shape[0]), 0)]
+        while stack:
+            lower, upper, candidates, depth = stack.pop()
+            cube_lower, cube_upper = self._expand(lower, upper)
+            sub = points[candidates]
+            inside = candidates[np.all((sub >= cube_lower) & (sub <= cube_upper), axis = 1)]
+            if len(inside) <= self.max_points or depth >= self.max_depth or np.all(upper - lower <= 0):
+                lowers.append(cube_lower)
+                uppers.append(cube_upper)
+                continue
+            mid = (lower + upper) / 2
+            #Quadrants are pushed in reverse so that cubes come out ordered (lower-left first)
+            for corner in [(1,1), (1,0), (0,1), (0,0)]:
+                q_lower = np.where(corner, mid, lower)
+                q_upper = np.where(corner, upper, mid)
+                stack.append((q_lower, q_upper, inside, depth + 1))
+        
+        self.lower_ = np.array(lowers)
+        self.upper_ = np.array(uppers)
+        self.centers_ = list((self.lower_ + self.upper_) / 2)
+        self.n_cubes = len(lowers)
+        if self.verbose > 0:
+            print(' - QuadtreeCover - %s cubes' % self.n_cubes)
+        return self.centers_
+    
+    def transform_single(self, data, i):
+        """
+        Returns the rows of data (first column an index column) in the ith cube.
+        """
+        coords = data[:, 1:]
+        entries = np.all((coords >= self.lower_[i]) & (coords <= self.upper_[i]), axis = 1)
+        return data[entries]
+    
+    def transform(self, data, centers = None):
+        """
+        Returns the list of rows of data in each cube, with empty cubes removed.
+        """
+        hypercubes = [self.transform_single(data, i) for i in range(self.n_cubes)]
+        return [cube for cube in hypercubes if len(cube)]
+    
+    def fit_transform(self, data):
+        self.fit(data)
+        return self.transform(data)
+    
+    def find(self, data_point):
+        """
+        Returns the list of indices of the cubes containing the given point, empty if the point is outside the cover.
+        """
+        inside = np.all((data_point >= self.lower_) & (data_point <= self.upper_), axis = 1)
+        return [int(i) for i in np.where(inside)[0]]
+
+def cover_bounds(cover):
+    """
+    Returns the lower and upper bounds of every cube of a fitted cover as two arrays of shape (n_cubes, n_dims). Works with km.Cover and QuadtreeCover.
+    """
+    if isinstance(cover, QuadtreeCover):
+        return cover.lower_, cover.upper_
+    centers = np.array(cover.centers_)
+    return centers - cover.radius_, centers + cover.radius_
+
+def min_cluster_samples(clusterer):
+    """
+    Returns the minimum number of points a hypercube must contain before it is clustered. Follows KeplerMapper: the first integer among the clusterer's n_clusters, min_cluster_size, or min_samples parameters, and 2 otherwise.
+    """
+    cluster_params = clusterer.get_params()
+    for parameter in ['n_clusters', 'min_cluster_size', 'min_samples']:
+        value = cluster_params.get(parameter)
+        if value and isinstance(value, int):
+            return value
+    return 2
+
+def _fit_predict_cube(clusterer, fit_data, metric = None):
+    #Module level so that it can be sent to worker processes.
+    #With a metric, the distance block of the cube is only computed here, right before fitting.
+    if metric is not None:
+        fit_data = pairwise_distances(fit_data, metric = metric)
+    return clusterer.fit_predict(fit_data)
+
+def map_over_cover(coords, data, clusterer, cover, precomputed = False, n_jobs = 1, metric = None):
+    """
+    Builds the same mapper graph as KeplerMapper.map(coords, X = data, clusterer = clusterer, cover = cover, precomputed = precomputed), but fits the clusterer on the hypercubes of the cover in a pool of n_jobs processes. Cube and node names follow KeplerMapper, so for a fixed clusterer the nodes and links are the same as the serial result.
+    
+    If a metric is given, data should be the raw features and the clusterer should accept a distance matrix. The distance matrix of each cube's members is computed just before that cube is clustered, so memory is bounded by the largest cube instead of the full (n_samples, n_samples) matrix.
+    args:
+        coords: numpy array of shape (n_samples, 2) used as the lens
+        data: dataframe or numpy array to cluster in each hypercube, or a distance matrix if precomputed is True
+        clusterer: clustering algorithm with a .fit_predict method. Must be picklable.
+        cover: the keplermapper cover to use
+        precomputed: whether data is a precomputed distance matrix
+        n_jobs: number of worker processes. -1 uses all cores.
+        metric: optional metric accepted by sklearn.metrics.pairwise_distances, used to compute distances within each cube
+    returns: mapper graph dictionary with 'nodes', 'links', 'simplices', 'meta_data', and 'meta_nodes'
+    """
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    X = np.asarray(data)
+    ids = np.arange(coords.shape[0])
+    lens = np.c_[ids, coords]
+    
+    #Split the cover, keeping only cubes large enough to cluster
+    cover.fit(lens)
+    min_samples = min_cluster_samples(clusterer)
+    cubes = []
+    for i, hypercube in enumerate(cover.transform(lens)):
+        if hypercube.shape[0] >= min_samples:
+            cubes.append((i, hypercube[:, 0].astype(int)))
+    
+    def fit_data(cube_ids):
+        return X[np.ix_(cube_ids, cube_ids)] if precomputed else X[cube_ids]
+    
+    if n_jobs == 1:
+        predictions = [_fit_predict_cube(clusterer, fit_data(cube_ids), metric) for _, cube_ids in cubes]
+    else:
+        with ProcessPoolExecutor(max_workers = n_jobs) as executor:
+            futures = [executor.submit(_fit_predict_cube, clusterer, fit_data(cube_ids), metric) for _, cube_ids in cubes]
+            predictions = [future.result() for future in futures]
+    
+    #Collect the nodes in cube order, named as in KeplerMapper
+    nodes = defaultdict(list)
+    for (i, cube_ids), cluster_predictions in zip(cubes, predictions):
+        for pred in np.unique(cluster_predictions):
+            if pred != -1 and not np.isnan(pred):
+                nodes['cube{}_cluster{}'.format(i, int(pred))] = cube_ids[cluster_predictions == pred].tolist()
+    
+    nerve = km.GraphNerve()
+    links, simplices = nerve.compute(nodes)
+    return {'nodes': nodes,
+            'links': links,
+            'simplices': simplices,
+            'meta_data': {'projection': 'custom',
+                          'n_cubes': cover.n_cubes,
+                          'perc_overlap': cover.perc_overlap,
+                          'clusterer': str(clusterer),
+                          'scaler': str(None),
+                          'nerve_min_intersection': nerve.min_intersection},
+            'meta_nodes': defaultdict(list)}
+
 class ClusterOverCoords:
     """
     Clusters using the specified clusterer using the mapper algorithm over the coordinates. 'data' and 'coords' must have the same length. Each row of the data will be associated with the coordinates at the same row of coords by the mapper. 
@@ -80,30 +384,42 @@ class ClusterOverCoords:
         data: the data to be clustered
         coords: the (x,y) or (lat,long) coordinates associated with each row of data
         clusterer: clustering algorithm with .fit and .predict methods
-        cover: the keplermapper cover being used
+        cover: the keplermapper cover being used. A QuadtreeCover can be passed instead to adapt the cubes to the density of the coordinates. Defaults to a new km.Cover(n_cubes = 20, perc_overlap = 0.3) for every instance.
         graph: the mapper graph of the data. 
         A: sparse adjacency matrix of mapper graph extended to the data of size (n_samples, n_samples)
         components: numpy array of labels of connected components of the mapper graph on the data. These can be thought of as cluster global cluster labels. Has size (n_samples,)
         precomputed: boolean parameter specifying if the data is a precomputed distance matrix. When set to true, make sure that clustering algorithm also accepts distance matrices, and set its precomputed parameter to true as well, if needed.
+        metric: optional metric for sklearn.metrics.pairwise_distances. When given, data holds the raw features and the distance matrix of each cube is computed just before its clusterer runs, so no (n_samples, n_samples) matrix is needed. The clusterer must accept a distance matrix, and precomputed must be False.
+        n_jobs: number of processes used to cluster the hypercubes of the cover. With the default of 1 the graph is made by KeplerMapper.map. Otherwise the clusterer is fit on each cube in a process pool, and -1 uses all cores.
+        merge: either 'adjacency' (default) or 'union_find'. With 'adjacency', the components are found from the adjacency matrix A. With 'union_find', they are found directly from the nodes and links of the mapper graph, and A is only built the first time it is accessed.
         
     methods:
-        generate_clusters(): runs all methods needed to generate mapper graph, adjacency matrix on the data, and identify the components
+        generate_clusters(): runs all methods needed to generate mapper graph, adjacency matrix on the data (unless merge = 'union_find'), and identify the components
         generate_adjacency(): generates sparse adjacency matrix on the data. Will run method to construct the graph if none available
         make_graph(): makes mapper graph without running any other methods. Useful to check if graph is reasonable before generating adjacency matrix and component list.
         export_graph(filepath): exports mapper vizualization to filepath. If graph attribute is empty, runs make_graph() first.
+        update(new_data, new_coords): adds new rows, re-fits only the cubes containing them, and updates the graph and cluster labels in place.
+        save(path): saves the graph, adjacency matrix, and cluster labels to the directory at path, together with a hash of the inputs.
+        load(path): loads the results saved at path, after checking that they were computed from the same inputs.
          
     """
-    def __init__(self, data, coords: np.array, clusterer, cover = km.Cover(n_cubes = 20, perc_overlap = 0.3), precomputed = False):
+    def __init__(self, data, coords: np.array, clusterer, cover = None, precomputed = False, merge = 'adjacency', n_jobs = 1, metric = None):
         self.data = data
         self.coords = coords
         self.clusterer = clusterer
-        self.cover = cover
+        #A default cover object would be shared, and refit, by every instance
+        self.cover = cover if cover is not None else km.Cover(n_cubes = 20, perc_overlap = 0.3)
         self.graph = None
-        self.A = None
+        self._A = None
+        self.merge = merge
+        self.n_jobs = n_jobs
+        self.metric = metric
         self.components = None
         self.precomputed = precomputed
         self.n_clusters = None
         self._mapper = None
+        self._cube_names = None
+        self._cube_bounds = None
         
         try:
             assert isinstance(self.data, (pd.DataFrame, np.ndarray))
@@ -117,17 +433,39 @@ class ClusterOverCoords:
             assert self.coords.shape[1] == 2
         except:
             raise ValueError('coords must be a numpy array of shape (n_samples, 2)')
+        if self.merge not in ('adjacency', 'union_find'):
+            raise ValueError("merge must be 'adjacency' or 'union_find'")
+        if self.precomputed and self.metric is not None:
+            raise ValueError('metric should only be given when data holds raw features, not a precomputed distance matrix')
+    
+    @property
+    def A(self):
+        #With union-find merging or after an update, the adjacency matrix is only built on request
+        if self._A is None and self.components is not None:
+            self.generate_adjacency()
+        return self._A
+    
+    @A.setter
+    def A(self, value):
+        self._A = value
         
     def make_graph(self):
         self._mapper = km.KeplerMapper()
-
-        self.graph = self._mapper.map(
-        self.coords,
-        X= self.data.copy(),
-        clusterer = self.clusterer,
-        cover=self.cover,
-        precomputed = self.precomputed
-    )
+        self._cube_names = None
+        
+        if self.n_jobs != 1 or self.metric is not None:
+            self.graph = map_over_cover(self.coords, self.data, self.clusterer, self.cover,
+                                        precomputed = self.precomputed, n_jobs = self.n_jobs, metric = self.metric)
+        else:
+            self.graph = self._mapper.map(
+            self.coords,
+            X= self.data.copy(),
+            clusterer = self.clusterer,
+            cover=self.cover,
+            precomputed = self.precomputed
+        )
+        #Snapshot of the cubes the graph was built with, used by update even if the cover is refit elsewhere
+        self._cube_bounds = cover_bounds(self.cover)
     
     def export_graph(self, filepath = 'output.html'):
         if self.graph is None:
@@ -140,22 +478,255 @@ class ClusterOverCoords:
         if self.graph is None:
             self.make_graph()
             
-        self.A = graph_to_adjacency(self.data,self.graph)
+        self.A = graph_to_adjacency_sparse(self.data,self.graph)
         
     def generate_clusters(self):
-        if self.A is None:
-            self.generate_adjacency()
-        graph = csgraph.connected_components(self.A, directed = False)
+        if self.merge == 'union_find':
+            if self.graph is None:
+                self.make_graph()
+            graph = graph_to_components(self.data.shape[0], self.graph)
+        else:
+            if self._A is None:
+                self.generate_adjacency()
+            graph = csgraph.connected_components(self._A, directed = False)
             
         self.components = graph[1]
         self.n_clusters = graph[0]
     
-    def plot_cluster_map(self, figsize = (10,10), fig = None, ax = None, **kwargs):
+    def _name_cubes(self):
+        #Node names use the position of each cube among the non-empty cubes, as in KeplerMapper.
+        #Returns an array mapping each cube of the cover to that position, -1 for empty cubes.
+        if self._cube_bounds is None:
+            #e.g. after load, the graph was not built in this session, so the cover is fit on the coordinates it was built from
+            self.cover.fit(np.c_[np.arange(self.coords.shape[0]), self.coords])
+            self._cube_bounds = cover_bounds(self.cover)
+        lower, upper = self._cube_bounds
+        names = -np.ones(len(lower), dtype = int)
+        count = 0
+        for i in range(len(lower)):
+            if np.any(np.all((self.coords >= lower[i]) & (self.coords <= upper[i]), axis = 1)):
+                names[i] = count
+                count += 1
+        return names
+    
+    def update(self, new_data, new_coords):
+        """
+        Adds new rows to the data and updates the mapper graph and cluster labels without re-running the whole pipeline. The cubes are those the graph was built with, even if the cover object was refit since. Only the cubes containing one of the new coordinates are re-clustered, their nodes and links are replaced in the graph, and the components are recomputed only for the clusters touching a re-clustered cube.
+        
+        Clusters which were not affected keep their labels, and so does any affected cluster whose members did not change. Other clusters get new labels, larger than all existing ones. New points outside every cube become their own clusters. The adjacency matrix A is rebuilt the next time it is accessed.
+        
+        args:
+            new_data: dataframe or numpy array of new rows, with the same columns as data
+            new_coords: numpy array of shape (n_new, 2) of the coordinates of the new rows
+        """
+        if self.precomputed:
+            raise ValueError('update is not available for a precomputed distance matrix. Pass raw features with a metric instead.')
+        if new_data.shape[0] != new_coords.shape[0]:
+            raise ValueError('new_data and new_coords must be the same length')
+        if self.components is None:
+            self.generate_clusters()
+        if self._cube_names is None:
+            self._cube_names = self._name_cubes()
+        
+        n_old = self.data.shape[0]
+        if isinstance(self.data, pd.DataFrame):
+            self.data = pd.concat([self.data, pd.DataFrame(new_data, columns = self.data.columns)], ignore_index = True)
+        else:
+            self.data = np.vstack([self.data, np.asarray(new_data)])
+        self.coords = np.vstack([self.coords, new_coords])
+        new_ids = np.arange(n_old, self.coords.shape[0])
+        
+        #Cubes containing a new point, in the cubes the graph was built with
+        lower, upper = self._cube_bounds
+        touched = [i for i in range(len(lower))
+                   if np.any(np.all((new_coords >= lower[i]) & (new_coords <= upper[i]), axis = 1))]
+        
+        #Re-cluster the touched cubes
+        nodes = self.graph['nodes']
+        links = self.graph['links']
+        X = np.asarray(self.data)
+        min_samples = min_cluster_samples(self.clusterer)
+        removed = set()
+        added = []
+        for i in touched:
+            if self._cube_names[i] < 0:
+                self._cube_names[i] = self._cube_names.max() + 1
+            prefix = 'cube{}_'.format(self._cube_names[i])
+            removed.update(node for node in nodes if node.startswith(prefix))
+            
+            cube_ids = np.where(np.all((self.coords >= lower[i]) & (self.coords <= upper[i]), axis = 1))[0]
+            if len(cube_ids) < min_samples:
+                continue
+            cluster_predictions = _fit_predict_cube(self.clusterer, X[cube_ids], self.metric)
+            for pred in np.unique(cluster_predictions):
+                if pred != -1 and not np.isnan(pred):
+                    added.append((prefix + 'cluster{}'.format(int(pred)), cube_ids[cluster_predictions == pred].tolist()))
+        
+        #Points whose cluster may change: members of replaced or new nodes, and the new points
+        affected = set(new_ids.tolist())
+        for node in removed:
+            affected.update(nodes[node])
+        for _, members in added:
+            affected.update(members)
+        
+        #Patch the nodes and links. New nodes go last, so they are linked from earlier nodes as in GraphNerve.
+        for node in removed:
+            del nodes[node]
+            links.pop(node, None)
+        for node in list(links.keys()):
+            links[node] = [branch for branch in links[node] if branch not in removed]
+            if not links[node]:
+                del links[node]
+        point_nodes = defaultdict(list)
+        for node, members in nodes.items():
+            for ind in members:
+                point_nodes[ind].append(node)
+        for name, members in added:
+            linked = []
+            for ind in members:
+                for node in point_nodes[ind]:
+                    if node not in linked:
+                        linked.append(node)
+            for node in linked:
+                links[node].append(name)
+            nodes[name] = members
+            for ind in members:
+                point_nodes[ind].append(name)
+        self.graph['simplices'] = [[n] for n in nodes] + [[x, end] for x in links for end in links[x]]
+        
+        #Old clusters touching an affected point are recomputed together with the new points
+        old_labels = self.components
+        dirty_labels = set(old_labels[[ind for ind in affected if ind < n_old]].tolist())
+        dirty = np.concatenate([np.where(np.isin(old_labels, list(dirty_labels)))[0], new_ids])
+        ds = DisjointSet(self.coords.shape[0])
+        dirty_nodes = set(node for ind in dirty for node in point_nodes[ind])
+        for node in dirty_nodes:
+            members = nodes[node]
+            for ind in members[1:]:
+                ds.union(members[0], ind)
+            for branch in links.get(node, []):
+                ds.union(members[0], nodes[branch][0])
+        groups = defaultdict(list)
+        for ind in dirty:
+            groups[ds.find(ind)].append(ind)
+        
+        #Keep the label of an old cluster whose members did not change
+        old_members = {label: set(np.where(old_labels == label)[0].tolist()) for label in dirty_labels}
+        components = np.concatenate([old_labels, -np.ones(len(new_ids), dtype = old_labels.dtype)])
+        next_label = old_labels.max() + 1 if len(old_labels) else 0
+        for members in sorted(groups.values(), key = min):
+            label = old_labels[members[0]] if members[0] < n_old else None
+            if label is None or old_members[label] != set(members):
+                label = next_label
+                next_label += 1
+            components[members] = label
+        
+        self.components = components
+        self.n_clusters = len(np.unique(components))
+        self._A = None
+    
+    def content_hash(self):
+        """
+        Returns a sha256 hex digest of the data (by value, so that equal object columns give the same digest), coords, cover, clusterer parameters, and clustering options. Used by save and load to detect results computed from different inputs.
+        """
+        h = hashlib.sha256()
+        if isinstance(self.data, pd.DataFrame):
+            h.update(repr(list(self.data.columns)).encode())
+        #Hashed by value, as the bytes of an object column are pointers to its values
+        h.update(pd.util.hash_pandas_object(pd.DataFrame(self.data), index = False).values.tobytes())
+        h.update(np.ascontiguousarray(self.coords).tobytes())
+        h.update(repr(self.cover).encode())
+        h.update(repr(sorted(self.clusterer.get_params().items())).encode())
+        h.update(repr((self.precomputed, self.metric)).encode())
+        return h.hexdigest()
+    
+    def save(self, path):
+        """
+        Saves the mapper graph, adjacency matrix, and cluster labels to the directory at path, running generate_clusters first if needed.
+        
+        The node membership is stored as one flat array of data indices with node offsets, and the links as arrays of source and target node positions. A and components are stored as .npy files, so they can be memory-mapped by load. A manifest.json records the node names, graph metadata, and content_hash of the inputs.
+        """
+        if self.components is None:
+            self.generate_clusters()
+        os.makedirs(path, exist_ok = True)
+        
+        names = list(self.graph['nodes'].keys())
+        position = {node: k for k, node in enumerate(names)}
+        members = [self.graph['nodes'][node] for node in names]
+        offsets = np.concatenate([[0], np.cumsum([len(x) for x in members])]).astype(np.int64)
+        flat = np.concatenate(members).astype(np.int64) if members else np.array([], dtype = np.int64)
+        edges = [(position[x], position[end]) for x in self.graph['links'] for end in self.graph['links'][x]]
+        edges = np.array(edges, dtype = np.int64).reshape(-1, 2)
+        
+        np.save(os.path.join(path, 'node_members.npy'), flat)
+        np.save(os.path.join(path, 'node_offsets.npy'), offsets)
+        np.save(os.path.join(path, 'links.npy'), edges)
+        np.save(os.path.join(path, 'components.npy'), self.components)
+        A = self.A
+        np.save(os.path.join(path, 'A_data.npy'), A.data)
+        np.save(os.path.join(path, 'A_indices.npy'), A.indices)
+        np.save(os.path.join(path, 'A_indptr.npy'), A.indptr)
+        
+        manifest = {'content_hash': self.content_hash(),
+                    'n_samples': int(self.coords.shape[0]),
+                    'n_clusters': int(self.n_clusters),
+                    'nodes': names,
+                    'meta_data': self.graph.get('meta_data', {})}
+        with open(os.path.join(path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, default = str)
+    
+    def load(self, path, mmap_mode = 'r'):
+        """
+        Loads the graph, adjacency matrix, and cluster labels saved by save at path. Raises a ValueError if they were computed from different data, coords, cover, or clusterer parameters than this object's, since the saved clustering cannot be trusted then.
+        
+        args:
+            path: directory passed to save
+            mmap_mode: mode passed to np.load for A and components. 'r' memory-maps them read-only, and None reads them into memory.
+        """
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest['content_hash'] != self.content_hash():
+            raise ValueError('The clustering saved at {} was computed from different inputs'.format(path))
+        
+        flat = np.load(os.path.join(path, 'node_members.npy'))
+        offsets = np.load(os.path.join(path, 'node_offsets.npy'))
+        edges = np.load(os.path.join(path, 'links.npy'))
+        names = manifest['nodes']
+        nodes = defaultdict(list)
+        for k, node in enumerate(names):
+            nodes[node] = flat[offsets[k]:offsets[k+1]].tolist()
+        links = defaultdict(list)
+        for source, target in edges:
+            links[names[source]].append(names[target])
+        
+        self.graph = {'nodes': nodes,
+                      'links': links,
+                      'simplices': [[n] for n in nodes] + [[x, end] for x in links for end in links[x]],
+                      'meta_data': manifest['meta_data'],
+                      'meta_nodes': defaultdict(list)}
+        self._mapper = km.KeplerMapper()
+        self._cube_names = None
+        self._cube_bounds = None
+        
+        n = manifest['n_samples']
+        self._A = csr_matrix((np.load(os.path.join(path, 'A_data.npy'), mmap_mode = mmap_mode),
+                              np.load(os.path.join(path, 'A_indices.npy'), mmap_mode = mmap_mode),
+                              np.load(os.path.join(path, 'A_indptr.npy'), mmap_mode = mmap_mode)),
+                             shape = (n, n), copy = False)
+        self.components = np.load(os.path.join(path, 'components.npy'), mmap_mode = mmap_mode)
+        self.n_clusters = manifest['n_clusters']
+    
+    def plot_cluster_map(self, figsize = (10,10), fig = None, ax = None, raster = False, boundary = None, bins = 500, **kwargs):
         #XXX Check that this works. Want to be able to pass fig, ax.
         #If it doesnt work the original just didn't have those arguments
         #and fig, ax were generated at the beginning unconditionally
         if (not ax) or (not fig):
             fig, ax = plt.subplots(figsize = figsize)
+        if raster:
+            #Colour each cell of a lat/long grid by its most common cluster label, over the optional boundary
+            plot_raster_map(self.coords[:,0], self.coords[:,1], values = self.components, how = 'label',
+                            boundary = boundary, bins = bins, ax = ax, **kwargs)
+            return
         gdf = places_to_geom(pd.DataFrame({'latitude' : self.coords[:,0], 'longitude' : self.coords[:,1]}))
         
         gdf.plot(c = self.components, ax = ax, **kwargs)
@@ -177,3 +748,84 @@ class ClusterOverCoords:
             return pd.concat([self.data, pd.Series(self.components, name = clustername)], axis = 1)
     
         
+
+class LocalClusterSweep:
+    """
+    Sweeps the distance threshold of the local agglomerative clustering and the overlap of the cover without re-fitting. For each overlap, the data is split into cubes once, and a linkage tree is computed once per cube and cached. Each distance threshold is then a cut of the cached trees, so a sweep over many thresholds costs little more than a single fit.
+    
+    Cutting a tree at distance_threshold gives the same clusters as AgglomerativeClustering(n_clusters = None, distance_threshold = distance_threshold, linkage = linkage) on the cube, and the labels match ClusterOverCoords with that clusterer and km.Cover(n_cubes, perc_overlap).
+    
+    attributes:
+        data: dataframe or numpy array of features to cluster
+        coords: numpy array of shape (n_samples, 2) of coordinates
+        n_cubes: number of cubes along each dimension of the cover
+        linkage: 'ward', 'complete', 'average', or 'single'
+        metric: metric used to build the linkage trees. Must be 'euclidean' for ward.
+        
+    methods:
+        partition(perc_overlap): list of arrays of the data indices in each cube
+        linkage_trees(perc_overlap): list of (cube indices, linkage tree) pairs
+        components(distance_threshold, perc_overlap): number of clusters and cluster labels for one setting
+        sweep(distance_thresholds, perc_overlaps): DataFrame of the labels and cluster sizes for every setting
+    """
+    def __init__(self, data, coords, n_cubes = 20, linkage = 'ward', metric = 'euclidean'):
+        if data.shape[0] != coords.shape[0]:
+            raise ValueError('data and coords must be the same length')
+        self.data = data
+        self.coords = coords
+        self.n_cubes = n_cubes
+        self.linkage = linkage
+        self.metric = metric
+        self._partitions = {}
+        self._trees = {}
+        
+    def partition(self, perc_overlap = 0.3):
+        """
+        Returns the list of data indices in each non-empty cube of km.Cover(n_cubes, perc_overlap). Cached per overlap.
+        """
+        if perc_overlap not in self._partitions:
+            lens = np.c_[np.arange(self.coords.shape[0]), self.coords]
+            cover = km.Cover(n_cubes = self.n_cubes, perc_overlap = perc_overlap)
+            cover.fit(lens)
+            self._partitions[perc_overlap] = [hypercube[:, 0].astype(int) for hypercube in cover.transform(lens)]
+        return self._partitions[perc_overlap]
+    
+    def linkage_trees(self, perc_overlap = 0.3):
+        """
+        Returns a list of (cube indices, linkage tree) pairs for the cubes with at least 2 points. Cached per overlap.
+        """
+        if perc_overlap not in self._trees:
+            X = np.asarray(self.data)
+            self._trees[perc_overlap] = [(cube_ids, linkage_tree(X[cube_ids], method = self.linkage, metric = self.metric))
+                                         for cube_ids in self.partition(perc_overlap) if len(cube_ids) >= 2]
+        return self._trees[perc_overlap]
+    
+    def components(self, distance_threshold, perc_overlap = 0.3):
+        """
+        Returns the number of clusters and the array of cluster labels for one setting, by cutting the cached linkage trees.
+        """
+        #AgglomerativeClustering only merges below the threshold, while fcluster also merges at it
+        cut = np.nextafter(distance_threshold, -np.inf)
+        nodes = {}
+        for i, (cube_ids, tree) in enumerate(self.linkage_trees(perc_overlap)):
+            labels = fcluster(tree, cut, criterion = 'distance')
+            for label in np.unique(labels):
+                nodes['cube{}_cluster{}'.format(i, label)] = cube_ids[labels == label].tolist()
+        #Nodes are only linked when they share points, so the links do not change the components
+        return graph_to_components(self.coords.shape[0], {'nodes': nodes, 'links': {}})
+    
+    def sweep(self, distance_thresholds, perc_overlaps = (0.3,)):
+        """
+        Runs components for every pair of distance threshold and overlap.
+        
+        returns:
+            DataFrame with one row per setting, with columns 'perc_overlap', 'distance_threshold', 'n_clusters', 'components' (array of labels), and 'cluster_sizes' (DataFrame as returned by get_cluster_sizes)
+        """
+        rows = []
+        for perc_overlap in perc_overlaps:
+            for distance_threshold in distance_thresholds:
+                n_clusters, components = self.components(distance_threshold, perc_overlap)
+                cluster_sizes = pd.Series(components).value_counts().reset_index().rename({'index':'cluster_label', 0: 'n_members'}, axis = 1)
+                rows.append({'perc_overlap': perc_overlap, 'distance_threshold': distance_threshold,
+                             'n_clusters': n_clusters, 'components': components, 'cluster_sizes': cluster_sizes})
+        return pd.DataFrame(rows)